@@ -0,0 +1,326 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+"""Benchmark of delete_purged_volumes_bareos.py on synthetic catalogs.
+
+Every scale gets a SQLite catalog with the configured number of clients,
+filesets and daily jobs, sparse volume files with real Bareos labels in a
+temporary archive device, stub bls and bconsole executables on PATH and a
+director pid file naming the benchmark itself. The script then runs three
+times (cold dry run, warm dry run, deletion) and the phase timings of every
+run are appended as JSON lines to the output.
+
+The archive device must not be on the / filesystem, the script skips those
+as not mounted; the default work directory is /dev/shm."""
+import os
+import sys
+import json
+import time
+import getopt
+import random
+import shutil
+import sqlite3
+import struct
+import tempfile
+import platform
+from subprocess import Popen, PIPE, check_output
+
+BINROOT = os.path.abspath(os.path.dirname(sys.argv[0]))
+SCRIPT = os.path.join(os.path.dirname(BINROOT), 'delete_purged_volumes_bareos.py')
+sys.path.insert(0, os.path.dirname(BINROOT))
+from delete_purged_volumes.catalog import SQLiteCatalog
+
+scales = [100, 1000, 10000, 100000]
+clients_per_1000_jobs = 5
+filesets = 2
+full_every, diff_every = (30, 7)
+purged_ratio = 0.5
+jobs_per_volume = 1
+volume_size = 1024 * 1024 * 1024
+
+# Prints the fields of the first session label like bls -jv does
+STUB_BLS = '''#!%(python)s
+import sys, struct, time
+data = open(sys.argv[-1], 'rb').read(65536)
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data, self.pos = data, 0
+
+    def unpack(self, fmt):
+        value, = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def string(self):
+        end = self.data.index(b'\\0', self.pos)
+        value, self.pos = self.data[self.pos:end].decode(), end + 1
+        return value
+
+
+pos = 0
+while pos + 24 <= len(data):
+    block_len = struct.unpack_from('>I', data, pos + 4)[0]
+    rec = pos + 24
+    while rec + 12 <= pos + block_len:
+        fi, stream, n = struct.unpack_from('>iiI', data, rec)
+        if fi == -4:
+            r = Reader(data[rec + 12:rec + 12 + n])
+            r.string()
+            r.unpack('>I')
+            jobid = r.unpack('>I')
+            btime = r.unpack('>q')
+            r.unpack('>d')
+            r.string(), r.string(), r.string()
+            client = r.string()
+            r.string()
+            fileset = r.string()
+            r.unpack('>I')
+            level = chr(r.unpack('>I'))
+            print('Begin Job Session Record:')
+            print('JobId             : %%d' %% jobid)
+            print('ClientName        : %%s' %% client)
+            print('FileSet           : %%s' %% fileset)
+            print('JobLevel          : %%s' %% level)
+            print('Date written      : %%s' %% time.strftime('%%d-%%b-%%Y %%H:%%M', time.localtime(btime // 1000000)))
+            sys.exit(0)
+        rec += 12 + n
+    pos += block_len
+'''
+
+# Emulates the bconsole prompt/response protocol on the benchmark catalog
+STUB_BCONSOLE = '''#!%(python)s
+import os, re, sys, sqlite3
+con = sqlite3.connect(os.environ['BENCH_CATALOG'])
+print('Connecting to Director localhost:9101')
+print('1000 OK: bareos-dir Version: 20.0.0')
+print('Enter a period to cancel a command.')
+sys.stdout.flush()
+for line in sys.stdin:
+    line = line.strip()
+    print(line)
+    m = re.match(r'(delete|purge) volume=(\\S+) yes$', line)
+    if line.startswith('@echo '):
+        print(line[6:])
+    elif m:
+        cmd, volname = m.groups()
+        row = con.execute('SELECT MediaId FROM Media WHERE VolumeName=?', (volname,)).fetchone()
+        if row is None:
+            print('Error: Volume "%%s" not found in catalog.' %% volname)
+        elif cmd == 'delete':
+            con.execute('DELETE FROM JobMedia WHERE MediaId=?', row)
+            con.execute('DELETE FROM Media WHERE MediaId=?', row)
+            con.commit()
+            print('This command will delete volume %%s\\nand all Jobs saved on that volume from the Catalog' %% volname)
+        else:
+            con.execute("UPDATE Media SET VolStatus='Purged' WHERE MediaId=?", row)
+            con.commit()
+            print('1200 Volume %%s purged.' %% volname)
+    elif line in ('quit', 'exit'):
+        break
+    elif line:
+        print('%%s: is an invalid command.' %% line)
+    sys.stdout.flush()
+'''
+
+
+def ser_string(s):
+    return s.encode('utf-8') + b'\0'
+
+
+def label_block(number, records):
+    body = b''.join(struct.pack('>iiI', fi, stream, len(data)) + data for fi, stream, data in records)
+    return struct.pack('>III4sII', 0, 24 + len(body), number, b'BB02', 1, 0) + body
+
+
+def volume_labels(volname, jobid, client, fileset, level, jobtdate):
+    """First two blocks of a Bareos file volume: volume label and session label."""
+    btime = jobtdate * 1000000
+    vol_label = (ser_string('Bareos 2.0 immortal\n') + struct.pack('>Iqqdd', 20, btime, btime, 0, 0) +
+                 b''.join(ser_string(x) for x in (volname, '', 'Full', 'Backup', 'File', 'bench-sd', 'bench', '20', '')))
+    sos_label = (ser_string('Bareos 2.0 immortal\n') + struct.pack('>IIqd', 20, jobid, btime, 0) +
+                 b''.join(ser_string(x) for x in ('Full', 'Backup', 'backup-' + client, client,
+                                                 'backup-%s.%d' % (client, jobid), fileset)) +
+                 struct.pack('>II', ord('B'), ord(level)) + ser_string(''))
+    return label_block(1, [(-2, 0, vol_label)]) + label_block(2, [(-4, jobid, sos_label)])
+
+
+def generate(workdir, jobs, seed=1):
+    """Writes configs, a catalog and the archive device for jobs jobs."""
+    R = random.Random(seed)
+    archive = os.path.join(workdir, 'archive')
+    os.makedirs(archive)
+    con = sqlite3.connect(os.path.join(workdir, 'bareos.db'))
+    con.executescript(SQLiteCatalog.schema)
+    con.execute("INSERT INTO Storage VALUES (1, 'File')")
+    con.execute("INSERT INTO Pool VALUES (1, 'Full')")
+    nclients = max(1, jobs * clients_per_1000_jobs // 1000)
+    chains = [(c, f) for c in range(nclients) for f in range(filesets)]
+    days = max(1, jobs // len(chains))
+    for c in range(nclients):
+        con.execute('INSERT INTO Client VALUES (?, ?)', (c + 1, 'client%d-fd' % c))
+    for f in range(filesets):
+        con.execute('INSERT INTO FileSet VALUES (?, ?)', (f + 1, 'fileset%d' % f))
+    now = int(time.time())
+    jobid, mediaid, files = (0, 0, 0)
+    for c, f in chains:
+        start = now - days * 86400
+        client, fileset = ('client%d-fd' % c, 'fileset%d' % f)
+        purged_days = int(days * purged_ratio)
+        media = None
+        for d in range(days):
+            jobid += 1
+            jobtdate = start + d * 86400 + R.randint(0, 3600)
+            level = 'F' if d % full_every == 0 else ('D' if d % diff_every == 0 else 'I')
+            con.execute('INSERT INTO Job (JobId, Level, ClientId, JobTDate, FileSetId) VALUES (?, ?, ?, ?, ?)',
+                        (jobid, level, c + 1, jobtdate, f + 1))
+            purged = d < purged_days
+            if media is None or d % jobs_per_volume == 0:
+                mediaid += 1
+                volname = 'vol-%d-%d-%05d' % (c, f, d)
+                con.execute('INSERT INTO Media (MediaId, VolumeName, PoolId, StorageId, VolStatus, VolBytes) '
+                            'VALUES (?, ?, 1, 1, ?, ?)', (mediaid, volname, 'Purged' if purged else 'Full', volume_size))
+                media = mediaid
+                with open(os.path.join(archive, volname), 'wb') as vol:
+                    vol.write(volume_labels(volname, jobid, client, fileset, level, jobtdate))
+                    vol.truncate(volume_size)
+                files += 1
+            if not purged:
+                con.execute('INSERT INTO JobMedia (JobId, MediaId) VALUES (?, ?)', (jobid, media))
+    con.commit()
+    con.close()
+    with open(os.path.join(workdir, 'bareos-dir.conf'), 'w') as f:
+        f.write('Director {\n  Name = bench-dir\n  WorkingDirectory = %s\n}\n'
+                'Catalog {\n  Name = MyCatalog\n  dbdriver = "sqlite3"\n  dbname = "bareos"\n  dbuser = "bareos"\n}\n'
+                % workdir)
+    with open(os.path.join(workdir, 'bareos-sd.conf'), 'w') as f:
+        f.write('Device {\n  Name = dev-backup\n  Archive Device = %s\n}\n' % archive)
+    with open(os.path.join(workdir, 'storages.conf'), 'w') as f:
+        f.write('Storage {\n  Name = File\n  Device = dev-backup\n}\n')
+    with open(os.path.join(workdir, 'bareos-dir.9101.pid'), 'w') as f:
+        f.write('%d\n' % os.getpid())
+    return {'jobs': jobid, 'volumes': mediaid, 'files': files, 'clients': nclients, 'chains': len(chains)}
+
+
+def write_stubs(bindir):
+    os.makedirs(bindir)
+    for name, src in (('bls', STUB_BLS), ('bconsole', STUB_BCONSOLE)):
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(src % {'python': sys.executable})
+        os.chmod(path, 0o755)
+
+
+def run_script(workdir, name, args):
+    summary = os.path.join(workdir, 'metrics-%s.json' % name)
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + env.get('PATH', '')
+    env['BENCH_CATALOG'] = os.path.join(workdir, 'bareos.db')
+    env['TERM'] = 'dumb'
+    cmd = [sys.executable, SCRIPT, '--dir-conf', os.path.join(workdir, 'bareos-dir.conf'),
+           '--sd-conf', os.path.join(workdir, 'bareos-sd.conf'),
+           '--storages-conf', os.path.join(workdir, 'storages.conf'),
+           '--state-dir', workdir, '--metrics', summary] + args
+    started = time.time()
+    with open(os.path.join(workdir, 'output-%s.txt' % name), 'w') as out:
+        p = Popen(cmd, stdout=out, stderr=out, env=env)
+        p.wait()
+    wall = time.time() - started
+    if p.returncode != 0 or not os.path.exists(summary):
+        raise RuntimeError('%s run failed, see %s' % (name, os.path.join(workdir, 'output-%s.txt' % name)))
+    with open(summary) as f:
+        return wall, json.load(f)
+
+
+def script_version():
+    try:
+        return check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(SCRIPT),
+                            stderr=PIPE).decode().strip()
+    except Exception:
+        return None
+
+
+def usage():
+    print("""Usage: %s [options]
+
+  -h, --help              show this help
+  -s, --scales=N,N,...    number of jobs per catalog (default %s)
+  -o, --output=FILE       append JSON lines results to FILE (default bench_results.jsonl)
+  -w, --workdir=DIR       where catalogs and archive devices are created (default /dev/shm)
+  --clients=N             clients per 1000 jobs (default %d)
+  --filesets=N            filesets per client (default %d)
+  --full-every=N, --diff-every=N
+                          days between full and diff backups (default %d, %d)
+  --purged-ratio=R        part of every chain that is purged (default %.1f)
+  --jobs-per-volume=N     (default %d)
+  --keep                  keep the work directories
+""" % (os.path.basename(sys.argv[0]), ','.join(str(x) for x in scales), clients_per_1000_jobs, filesets,
+       full_every, diff_every, purged_ratio, jobs_per_volume))
+
+
+if __name__ == '__main__':
+    output = 'bench_results.jsonl'
+    workdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    keep = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:o:w:', ['help', 'scales=', 'output=', 'workdir=', 'clients=',
+                                                             'filesets=', 'full-every=', 'diff-every=',
+                                                             'purged-ratio=', 'jobs-per-volume=', 'keep'])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        sys.exit(2)
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-s', '--scales'):
+            scales = [int(x) for x in val.split(',')]
+        elif opt in ('-o', '--output'):
+            output = val
+        elif opt in ('-w', '--workdir'):
+            workdir = val
+        elif opt == '--clients':
+            clients_per_1000_jobs = int(val)
+        elif opt == '--filesets':
+            filesets = int(val)
+        elif opt == '--full-every':
+            full_every = int(val)
+        elif opt == '--diff-every':
+            diff_every = int(val)
+        elif opt == '--purged-ratio':
+            purged_ratio = float(val)
+        elif opt == '--jobs-per-volume':
+            jobs_per_volume = int(val)
+        elif opt == '--keep':
+            keep = True
+
+    version = script_version()
+    for jobs in scales:
+        root = tempfile.mkdtemp(prefix='dpvb-bench-', dir=workdir)
+        try:
+            started = time.time()
+            catalog = generate(root, jobs)
+            write_stubs(os.path.join(root, 'bin'))
+            generated = time.time() - started
+            print('%d jobs: %s, generated in %.1fs' % (jobs, catalog, generated))
+            for name, args in (('cold', ['--dry-run']), ('warm', ['--dry-run']), ('delete', ['--no-dry-run', '--full'])):
+                wall, summary = run_script(root, name, args)
+                result = {
+                    'time': time.time(), 'version': version, 'python': platform.python_version(),
+                    'scale': jobs, 'run': name, 'catalog': catalog, 'wall': wall,
+                    'phases': summary['phases'], 'counters': summary['counters'],
+                    'peak_rss_bytes': summary['peak_rss_bytes'],
+                    'params': {'clients_per_1000_jobs': clients_per_1000_jobs, 'filesets': filesets,
+                               'full_every': full_every, 'diff_every': diff_every,
+                               'purged_ratio': purged_ratio, 'jobs_per_volume': jobs_per_volume},
+                }
+                with open(output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+                print('  %-6s %7.2fs  %s' % (name, wall, '  '.join('%s %.2fs' % (phase, t['wall'])
+                                                                   for phase, t in summary['phases'].items())))
+        finally:
+            if keep:
+                print('  kept %s' % root)
+            else:
+                shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""Deletes purged Bareos volumes from disk and catalog.
+
+The command is delete_purged_volumes.cli.main, the pieces below are for
+tools that plan or monitor retention without running it."""
+
+from . import config
+from .bconsole import BconsoleSession, director_running
+from .catalog import Catalog, CatalogJob, load_catalog, open_catalog
+from .chains import BackupChain, ChainIndex
+from .cli import main, run
+from .conf import BareosConfig, load_config
+from .daemon import WatchDaemon, daemon_status
+from .deleter import del_backups
+from .metrics import Metrics, metrics
+from .partition import Partition
+from .planner import apply_plan, decide_diff, decide_full, decide_incr, plan_removals, write_plan
+from .simulate import RetentionPolicy, simulate_retention
+from .snapshot import SnapshotCatalog, write_snapshot
+
+__all__ = ['config', 'BconsoleSession', 'director_running', 'Catalog', 'CatalogJob', 'load_catalog',
+           'open_catalog', 'BackupChain', 'ChainIndex', 'main', 'run', 'BareosConfig', 'load_config',
+           'WatchDaemon', 'daemon_status', 'del_backups', 'Metrics', 'metrics', 'Partition', 'apply_plan',
+           'decide_diff', 'decide_full', 'decide_incr', 'plan_removals', 'write_plan', 'RetentionPolicy',
+           'simulate_retention', 'SnapshotCatalog', 'write_snapshot']
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Talking to the director: the bconsole session and the director probe."""
+
+import errno
+import os
+import re
+import select
+import socket
+from subprocess import PIPE, Popen, STDOUT
+
+from . import config
+from .conf import conf_get
+from .metrics import metrics
+from .partition import lock_file, lock_path
+from .util import bcolors, debug, print_color
+
+
+bconsole_error_re = re.compile(r'(?im)^.*(?:ERR=|\berror\b|\bfailed\b|\bnot found\b|\binvalid\b)')
+bconsole_not_found_re = re.compile(r'(?i)\bnot found\b|\bno volume\b')
+
+
+class BconsoleError(Exception):
+    pass
+
+
+class BconsoleSession(object):
+    """One bconsole process for the whole run.
+
+    Commands are queued and written in batches of batch_size, each followed by
+    "@echo <marker>" so the output of every command can be cut out of the
+    stream and checked for errors. When bconsole dies or doesn't answer a
+    command within timeout seconds the unanswered commands are sent again over
+    a new connection, up to retries times. Those may have run before, so a
+    delete sent again that finds no volume succeeded."""
+
+    def __init__(self, cmd=None, batch_size=None, retries=2, timeout=None):
+        self.cmd = cmd or config.bconsole_cmd
+        self.batch_size = batch_size or config.bconsole_batch_size
+        self.retries = retries
+        self.timeout = timeout or config.bconsole_timeout
+        self.proc = None
+        self.buf = b''
+        self.pending = list()
+        self.failed = list()
+        self.seq = 0
+
+    def _connect(self):
+        debug('Starting %s' % ' '.join(self.cmd))
+        metrics.inc('subprocess_spawns', program='bconsole')
+        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+
+    def _disconnect(self):
+        self.buf = b''
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.write(b'quit\n')
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+
+    def _readline(self):
+        """The next line of output, b'' when bconsole is gone, None when it didn't answer in time."""
+        fd = self.proc.stdout.fileno()
+        while b'\n' not in self.buf:
+            ready, w, x = select.select([fd], [], [], self.timeout)
+            if not ready:
+                return None
+            data = os.read(fd, 65536)
+            if not data:
+                line, self.buf = self.buf, b''
+                return line
+            self.buf += data
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line + b'\n'
+
+    def _marker(self):
+        self.seq += 1
+        return '@@%d-%d@@' % (os.getpid(), self.seq)
+
+    def _send(self, batch):
+        """Runs (volname, command) pairs, returns outputs of the answered ones."""
+        if self.proc is None or self.proc.poll() is not None:
+            self._connect()
+        markers = list()
+        try:
+            for volname, command in batch:
+                marker = self._marker()
+                markers.append(marker)
+                self.proc.stdin.write(('%s\n@echo %s\n' % (command, marker)).encode('utf-8'))
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            pass
+        outputs = list()
+        for marker in markers:
+            lines = list()
+            while True:
+                line = self._readline()
+                if line is None:
+                    print_color(bcolors.WARNING, 'bconsole did not answer within %ds' % self.timeout)
+                    metrics.inc('bconsole_timeouts')
+                    self.proc.kill()
+                    return outputs
+                if not line:
+                    return outputs
+                line = line.decode('utf-8', 'replace')
+                if line.strip() == marker:
+                    break
+                if line.strip() != '@echo %s' % marker:
+                    lines.append(line)
+            outputs.append(''.join(lines))
+        return outputs
+
+    def queue(self, volname, command):
+        """Queues a command, returns results of the batch it completed if any."""
+        self.pending.append((volname, command))
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return list()
+
+    def flush(self):
+        """Runs all queued commands, returns [(volname, command, ok, output)].
+
+        Runs side by side on other partitions write to the catalog one batch
+        at a time, under the bconsole lock in lock_dir."""
+        if not self.pending:
+            return list()
+        lock = lock_file(lock_path('bconsole'), blocking=True) if config.lock_dir else None
+        try:
+            return self._flush()
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def _flush(self):
+        results = list()
+        batch, self.pending = self.pending, list()
+        attempt = 0
+        while batch:
+            outputs = self._send(batch)
+            for (volname, command), out in zip(batch, outputs):
+                ok = not bconsole_error_re.search(out) or (attempt > 0 and self._done_before(command, out))
+                metrics.inc('bconsole_commands', result='ok' if ok else 'failed')
+                results.append((volname, command, ok, out))
+                if not ok:
+                    self.failed.append((volname, command, out))
+            batch = batch[len(outputs):]
+            if not batch:
+                break
+            attempt += 1
+            self._disconnect()
+            if attempt > self.retries:
+                for volname, command in batch:
+                    out = 'bconsole connection lost'
+                    metrics.inc('bconsole_commands', result='failed')
+                    results.append((volname, command, False, out))
+                    self.failed.append((volname, command, out))
+                break
+            print_color(bcolors.WARNING, 'bconsole connection lost, reconnecting (%d/%d)' % (attempt, self.retries))
+        return results
+
+    @staticmethod
+    def _done_before(command, out):
+        """Whether a command sent again found its work done by the lost connection."""
+        return command.startswith('delete ') and bool(bconsole_not_found_re.search(out))
+
+    def close(self):
+        results = self.flush()
+        self._disconnect()
+        return results
+
+
+session = None
+
+
+def get_bconsole():
+    """The bconsole session of this run, started with the first command."""
+    global session
+    if session is None:
+        session = BconsoleSession()
+    return session
+
+
+def flush_bconsole():
+    """Runs the queued commands, returns their results."""
+    if session is None:
+        return []
+    return session.flush()
+
+
+def close_bconsole():
+    """Ends the session, returns the results of the last commands and the failed ones."""
+    global session
+    if session is None:
+        return [], []
+    results = session.close()
+    failed = session.failed
+    session = None
+    return results, failed
+
+
+def print_bconsole_results(results):
+    for volname, command, ok, out in results:
+        print_color(bcolors.DARKGRAY, out.rstrip('\n'))
+        if not ok:
+            print_color(bcolors.FAIL, 'FAILED: %s' % command)
+        print('')
+
+
+def bconsole_purge_volume(volname):
+    """Force PURGE volume in catalog"""
+    print('Pruning %s' % volname)
+    if not config.dry_run:
+        print_bconsole_results(get_bconsole().queue(volname, 'purge volume=%s yes' % volname))
+
+
+director_pid_dirs = ('/var/run', '/var/run/bareos', '/run/bareos', '/var/lib/bareos')
+
+
+def director_running(director_cfg):
+    """Checks that the director is up without running `service status`.
+
+    The pid file the director writes (<daemon>.<port>.pid in its Pid Directory)
+    is looked up and its process probed, else the director port is connected."""
+    port = int(conf_get(director_cfg, 'DirPort') or 9101)
+    pid_dirs = [conf_get(director_cfg, 'PidDirectory'), conf_get(director_cfg, 'WorkingDirectory')]
+    for pid_dir in [d for d in pid_dirs if d] + list(director_pid_dirs):
+        for daemon in ('bareos-dir', 'bacula-dir'):
+            try:
+                with open(os.path.join(pid_dir, '%s.%d.pid' % (daemon, port)), 'r') as f:
+                    pid = int(f.read().strip())
+            except (IOError, OSError, ValueError):
+                continue
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno != errno.EPERM:
+                    # stale pid file
+                    continue
+            return True
+    try:
+        socket.create_connection((conf_get(director_cfg, 'DirAddress') or 'localhost', port), 1.0).close()
+    except (socket.error, OSError):
+        return False
+    return True
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""Catalog queries and the database drivers."""
+
+import os
+from datetime import datetime, timedelta
+from sys import intern
+
+from .util import to_str
+
+
+class CatalogJob(object):
+    """One job on a volume, the columns of the catalog join the decisions need."""
+    __slots__ = ('volumename', 'jobtdate', 'level', 'clientname', 'fileset')
+
+    def __init__(self, volumename, jobtdate, level, clientname, fileset):
+        self.volumename = volumename
+        self.jobtdate = jobtdate
+        self.level = level
+        self.clientname = clientname
+        self.fileset = fileset
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class Catalog(object):
+    """Queries the script runs against the catalog database.
+
+    Subclasses connect with their driver and provide an unbuffered cursor so
+    the big job join streams; everything else is plain SQL shared by all of
+    them, written with %s placeholders. The script only reads: queries that
+    must agree run between begin_transaction and end_transaction, so they see
+    one snapshot of the catalog, and a long lived connection ends its read
+    transaction so it sees what was committed since and doesn't hold back
+    vacuum."""
+
+    name = None
+    fetch_size = 10000
+    # Media.LastWritten of a volume that never got written
+    never_written = 'LastWritten IS NULL'
+    # Starts a transaction whose queries all read the same snapshot
+    begin_read = None
+
+    def __init__(self):
+        self.con = None
+        self.identity = dict()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def stream_cursor(self):
+        return self.con.cursor()
+
+    def sql(self, query):
+        return query
+
+    def timestamp(self, dt):
+        return dt
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def begin_transaction(self):
+        """Starts a read transaction, the queries until end_transaction see one snapshot."""
+        self.end_transaction()
+        if self.con is not None and self.begin_read:
+            cur = self.con.cursor()
+            cur.execute(self.begin_read)
+            cur.close()
+
+    def end_transaction(self):
+        if self.con is not None:
+            self.con.rollback()
+
+    def query(self, query, params=(), stream=False):
+        """Yields result rows as tuples, fetched in chunks of fetch_size."""
+        cur = self.stream_cursor() if stream else self.con.cursor()
+        try:
+            cur.execute(self.sql(query), params)
+            while True:
+                rows = cur.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
+    def query_dicts(self, query, keys, params=()):
+        return [dict(zip(keys, [to_str(v) for v in row])) for row in self.query(query, params)]
+
+    @staticmethod
+    def name_filter(column, names):
+        """SQL condition and params restricting column to names, none for all."""
+        if not names:
+            return '', ()
+        return ' AND %s IN (%s)' % (column, ', '.join(['%s'] * len(names))), tuple(names)
+
+    def iter_jobs(self, clients=None):
+        """Streams jobs on not purged volumes as CatalogJob, of clients if given.
+
+        Repeated strings are interned, so only the compact records are kept."""
+        condition, params = self.name_filter('c.Name', clients)
+        rows = self.query('SELECT DISTINCT m.VolumeName, j.JobTDate, j.Level, c.Name, f.FileSet, j.FileSetId, j.ClientId '
+                          'FROM Media m, Job j, JobMedia jm, FileSet f, Client c WHERE '
+                          'jm.MediaId=m.MediaId AND jm.JobId=j.JobId AND f.FileSetId=j.FileSetId AND '
+                          "j.ClientId=c.ClientId AND m.VolStatus<>'Purged'" + condition, params, stream=True)
+        for volumename, jobtdate, level, clientname, fileset, filesetid, clientid in rows:
+            yield CatalogJob(intern(to_str(volumename)), int(jobtdate), intern(to_str(level)),
+                             intern(to_str(clientname)), intern(to_str(fileset)))
+
+    def purged_volnames_with_jobs(self):
+        return set(intern(to_str(x[0])) for x in self.query(
+            'SELECT DISTINCT m.VolumeName FROM Media m, JobMedia jm WHERE '
+            "jm.MediaId=m.MediaId AND m.VolStatus='Purged'"))
+
+    def purged_volumes(self, pools=None, storages=None):
+        """Purged volumes with their storage and pool, in the pools and storages if given."""
+        pool_condition, pool_params = self.name_filter('p.Name', pools)
+        storage_condition, storage_params = self.name_filter('s.Name', storages)
+        return self.query_dicts('SELECT DISTINCT m.VolumeName, s.Name, p.Name FROM Media m '
+                                'JOIN Storage s ON m.StorageId=s.StorageId LEFT JOIN Pool p ON m.PoolId=p.PoolId '
+                                "WHERE m.VolStatus='Purged'" + pool_condition + storage_condition,
+                                ('volname', 'storagename', 'poolname'), pool_params + storage_params)
+
+    def media_state(self):
+        """(highest MediaId, newest LastWritten, number and MediaId sum of purged
+        volumes, number of jobs and highest JobId).
+
+        One scan of the Media table and the Job index, it changes when volumes
+        are added, written, purged or deleted and when jobs are added or pruned."""
+        row = list(self.query("SELECT MAX(MediaId), MAX(LastWritten), "
+                              "SUM(CASE WHEN VolStatus='Purged' THEN 1 ELSE 0 END), "
+                              "SUM(CASE WHEN VolStatus='Purged' THEN MediaId ELSE 0 END), "
+                              "(SELECT COUNT(*) FROM Job), (SELECT MAX(JobId) FROM Job) FROM Media"))[0]
+        return (row[0] or 0, row[1], int(row[2] or 0), int(row[3] or 0), int(row[4] or 0), row[5] or 0)
+
+    def client_job_counts(self):
+        """{client name: number of jobs}, tells the clients whose jobs were pruned."""
+        return dict((intern(to_str(name)), int(count)) for name, count in self.query(
+            'SELECT c.Name, COUNT(*) FROM Job j, Client c WHERE j.ClientId=c.ClientId GROUP BY c.Name'))
+
+    def clients_written_since(self, media_id, last_written, job_id=0):
+        """Clients with jobs after job_id or on volumes added after media_id or written after last_written."""
+        condition, params = 'j.JobId > %s OR m.MediaId > %s', (job_id, media_id)
+        if last_written is None:
+            condition += ' OR m.LastWritten IS NOT NULL'
+        else:
+            condition += ' OR m.LastWritten > %s'
+            params += (last_written,)
+        return set(intern(to_str(x[0])) for x in self.query(
+            'SELECT DISTINCT c.Name FROM Media m, JobMedia jm, Job j, Client c WHERE '
+            'jm.MediaId=m.MediaId AND jm.JobId=j.JobId AND j.ClientId=c.ClientId AND (%s)' % condition, params))
+
+    # JobStatus of jobs that are running or waiting on the storage daemon
+    running_job_statuses = ('R', 'B', 'm', 'M', 's', 'S')
+
+    def busy_storages(self):
+        """Names of the storages with volumes that running jobs write to."""
+        return set(to_str(x[0]) for x in self.query(
+            'SELECT DISTINCT s.Name FROM Job j, JobMedia jm, Media m, Storage s WHERE '
+            'jm.JobId=j.JobId AND jm.MediaId=m.MediaId AND m.StorageId=s.StorageId AND '
+            'j.JobStatus IN (%s)' % ', '.join(["'%s'" % x for x in self.running_job_statuses])))
+
+    def media_volnames(self):
+        return set(to_str(x[0]) for x in self.query('SELECT VolumeName FROM Media', stream=True))
+
+    def iter_media(self):
+        """Yields (VolumeName, storage name, VolStatus, VolBytes, pool name) of all volumes."""
+        return self.query('SELECT m.VolumeName, s.Name, m.VolStatus, m.VolBytes, p.Name FROM Media m '
+                          'LEFT JOIN Storage s ON s.StorageId=m.StorageId '
+                          'LEFT JOIN Pool p ON p.PoolId=m.PoolId', stream=True)
+
+    media_columns = ('MediaId', 'VolumeName', 'VolBytes', 'FirstWritten', 'LabelDate', 'InitialWrite', 'LastWritten', 'VolStatus')
+
+    def failed_volumes(self):
+        """Used volumes labeled more than a day ago that never got written."""
+        label_before = self.timestamp(datetime.now() - timedelta(days=1))
+        return self.query_dicts('SELECT %s FROM Media WHERE %s AND VolStatus = \'Used\' '
+                                'AND LabelDate < %%s AND VolBytes < 10240' % (', '.join(self.media_columns), self.never_written),
+                                self.media_columns, (label_before,))
+
+    def recycle_volumes(self):
+        return self.query_dicts('SELECT %s FROM Media WHERE Recycle = 1' % ', '.join(self.media_columns),
+                                self.media_columns)
+
+
+class MySQLCatalog(Catalog):
+    name = 'mysql'
+    never_written = "(LastWritten IS NULL OR LastWritten = '0000-00-00 00:00:00')"
+    begin_read = 'START TRANSACTION WITH CONSISTENT SNAPSHOT'
+
+    def __init__(self, db_name, db_user, db_pass, db_host='', db_port=0):
+        Catalog.__init__(self)
+        import MySQLdb
+        import MySQLdb.cursors
+        self.driver = MySQLdb
+        kwargs = {'db': db_name, 'user': db_user, 'passwd': db_pass}
+        if db_host:
+            kwargs['host'] = db_host
+        if db_port:
+            kwargs['port'] = int(db_port)
+        self.kwargs = kwargs
+
+    def connect(self):
+        self.con = self.driver.connect(**self.kwargs)
+
+    def stream_cursor(self):
+        return self.con.cursor(self.driver.cursors.SSCursor)
+
+
+class PostgreSQLCatalog(Catalog):
+    name = 'postgresql'
+    # psycopg2 sends BEGIN first, READ COMMITTED would take a snapshot per query
+    begin_read = 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'
+
+    def __init__(self, db_name, db_user, db_pass, db_host='', db_port=0):
+        Catalog.__init__(self)
+        import psycopg2
+        self.driver = psycopg2
+        kwargs = {'database': db_name, 'user': db_user, 'password': db_pass}
+        if db_host:
+            kwargs['host'] = db_host
+        if db_port:
+            kwargs['port'] = int(db_port)
+        self.kwargs = kwargs
+        self.cursors = 0
+
+    def connect(self):
+        self.con = self.driver.connect(**self.kwargs)
+
+    def stream_cursor(self):
+        # Named cursors live on the server and are fetched fetch_size rows at a time
+        self.cursors += 1
+        cur = self.con.cursor(name='delete_purged_volumes_%d' % self.cursors)
+        cur.itersize = self.fetch_size
+        return cur
+
+
+class SQLiteCatalog(Catalog):
+    """SQLite catalog, also used to run the script against a local test catalog."""
+    name = 'sqlite3'
+    never_written = "(LastWritten IS NULL OR LastWritten = 0 OR LastWritten = '0000-00-00 00:00:00')"
+    begin_read = 'BEGIN'
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS Client (ClientId INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS FileSet (FileSetId INTEGER PRIMARY KEY, FileSet TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS Storage (StorageId INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS Pool (PoolId INTEGER PRIMARY KEY, Name TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS Job (
+            JobId INTEGER PRIMARY KEY, Job TEXT, Name TEXT, Type CHAR DEFAULT 'B', Level CHAR NOT NULL,
+            ClientId INTEGER, JobStatus CHAR DEFAULT 'T', JobTDate INTEGER NOT NULL, FileSetId INTEGER);
+        CREATE TABLE IF NOT EXISTS Media (
+            MediaId INTEGER PRIMARY KEY, VolumeName TEXT NOT NULL, PoolId INTEGER, StorageId INTEGER,
+            VolStatus TEXT NOT NULL, VolBytes INTEGER DEFAULT 0, Recycle INTEGER DEFAULT 0,
+            FirstWritten DATETIME DEFAULT 0, LastWritten DATETIME DEFAULT 0, LabelDate DATETIME DEFAULT 0,
+            InitialWrite DATETIME DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS JobMedia (JobMediaId INTEGER PRIMARY KEY, JobId INTEGER, MediaId INTEGER);
+        CREATE INDEX IF NOT EXISTS JobMedia_JobId ON JobMedia (JobId);
+        CREATE INDEX IF NOT EXISTS JobMedia_MediaId ON JobMedia (MediaId);
+        CREATE INDEX IF NOT EXISTS Media_VolStatus ON Media (VolStatus);
+    '''
+
+    def __init__(self, path):
+        Catalog.__init__(self)
+        import sqlite3
+        self.driver = sqlite3
+        self.path = path
+
+    def connect(self):
+        self.con = self.driver.connect(self.path)
+
+    def sql(self, query):
+        return query.replace('%s', '?')
+
+    def timestamp(self, dt):
+        return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    def create_schema(self):
+        self.con.executescript(self.schema)
+
+
+def open_catalog(catalog_cfg, working_dir=None):
+    """Returns a connected Catalog for a Catalog resource of the director config."""
+    db_driver = catalog_cfg['dbdriver']
+    db_name   = catalog_cfg['dbname']
+    if db_driver in ('sqlite', 'sqlite3'):
+        path = os.path.join(working_dir or '.', db_name + '.db')
+        print("Connecting to %s %s\n" % (db_driver, path))
+        catalog = SQLiteCatalog(path)
+    else:
+        db_host   = catalog_cfg.get('dbaddress', '')
+        db_port   = catalog_cfg.get('dbport', 0)
+        db_user   = catalog_cfg['dbuser']
+        db_pass   = catalog_cfg.get('dbpassword', '')
+        print("Connecting to %s %s@%s:%s/%s\n" % (db_driver, db_user, db_host, db_port, db_name))
+        if db_driver == 'mysql':
+            catalog = MySQLCatalog(db_name, db_user, db_pass, db_host, db_port)
+        elif db_driver in ('postgresql', 'postgres'):
+            catalog = PostgreSQLCatalog(db_name, db_user, db_pass, db_host, db_port)
+        else:
+            raise ValueError('Unsupported dbdriver %s' % db_driver)
+    catalog.identity = {'catalog': catalog_cfg['Name'], 'driver': db_driver, 'name': db_name,
+                        'host': catalog_cfg.get('dbaddress', ''), 'port': catalog_cfg.get('dbport', 0)}
+    catalog.connect()
+    return catalog
+
+
+def load_catalog(bareos_config, snapshot=None):
+    """Returns the connected catalog of a BareosConfig, or of a snapshot file."""
+    if snapshot:
+        from .snapshot import SnapshotCatalog
+        catalog = SnapshotCatalog(snapshot)
+        catalog.connect()
+        return catalog
+    return open_catalog(bareos_config.catalog, bareos_config.working_dir)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Backups of a client/fileset sorted by level and jobtdate."""
+
+from bisect import bisect_left, bisect_right
+
+
+class BackupChain(object):
+    """Backups of one client/fileset pair, split by level and sorted by jobtdate.
+
+    Every lookup is a bisect over the level arrays, 'FD' is the merged
+    full+diff array used for "next full or diff" questions."""
+    __slots__ = ('times', 'rows')
+
+    def __init__(self):
+        self.times = {'F': [], 'D': [], 'I': [], 'FD': []}
+        self.rows = {'F': [], 'D': [], 'I': [], 'FD': []}
+
+    def add(self, t, row, level):
+        if level not in ('F', 'D', 'I'):
+            return
+        self.rows[level].append((t, row))
+        if level in ('F', 'D'):
+            self.rows['FD'].append((t, row))
+
+    def finalize(self):
+        for level, rows in self.rows.items():
+            rows.sort(key=lambda x: x[0])
+            self.times[level] = [t for t, row in rows]
+            self.rows[level] = [row for t, row in rows]
+
+    def all(self, levels):
+        return self.rows[levels]
+
+    def count(self, levels):
+        return len(self.times[levels])
+
+    def newer(self, levels, t):
+        """Backups with jobtdate > t"""
+        return self.rows[levels][bisect_right(self.times[levels], t):]
+
+    def next_after(self, levels, t):
+        """First backup with jobtdate > t or None"""
+        i = bisect_right(self.times[levels], t)
+        if i < len(self.rows[levels]):
+            return self.rows[levels][i]
+
+    def prev_before(self, levels, t):
+        """Last backup with jobtdate < t or None"""
+        i = bisect_left(self.times[levels], t)
+        if i > 0:
+            return self.rows[levels][i - 1]
+
+    def _range(self, levels, t1, t2):
+        times = self.times[levels]
+        lo = 0 if t1 is None else bisect_right(times, t1)
+        hi = len(times) if t2 is None else bisect_left(times, t2)
+        return lo, max(lo, hi)
+
+    def between(self, levels, t1, t2):
+        """Backups with t1 < jobtdate < t2, None means unbounded"""
+        lo, hi = self._range(levels, t1, t2)
+        return self.rows[levels][lo:hi]
+
+    def count_between(self, levels, t1, t2):
+        lo, hi = self._range(levels, t1, t2)
+        return hi - lo
+
+
+class ChainIndex(object):
+    """Backup chains grouped by (clientname, fileset).
+
+    Built once per run, the daemon replaces the chains of changed clients."""
+
+    EMPTY = BackupChain()
+
+    def __init__(self, rows, client_key='clientname', fileset_key='fileset', time_key='jobtdate', level_key='level'):
+        self.keys = (client_key, fileset_key, time_key, level_key)
+        self.chains, self.size = self.build(rows)
+
+    def build(self, rows):
+        client_key, fileset_key, time_key, level_key = self.keys
+        chains = dict()
+        size = 0
+        for row in rows:
+            key = (row[client_key], row[fileset_key])
+            chain = chains.get(key)
+            if chain is None:
+                chain = chains[key] = BackupChain()
+            level = row[level_key] if level_key else 'F'
+            chain.add(row[time_key], row, level)
+            size += 1
+        for chain in chains.values():
+            chain.finalize()
+        return chains, size
+
+    def replace_clients(self, clients, rows):
+        """Replaces the chains of clients by the ones built from rows, all jobs of those clients."""
+        clients = set(clients)
+        for key in [key for key in self.chains if key[0] in clients]:
+            chain = self.chains.pop(key)
+            self.size -= chain.count('F') + chain.count('D') + chain.count('I')
+        chains, size = self.build(rows)
+        self.chains.update(chains)
+        self.size += size
+
+    def chain(self, client, fileset):
+        return self.chains.get((client, fileset), self.EMPTY)
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""The delete_purged_volumes_bareos command."""
+
+import getopt
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from . import config, util
+from .bconsole import bconsole_purge_volume, director_running, flush_bconsole, print_bconsole_results
+from .catalog import load_catalog
+from .chains import ChainIndex
+from .conf import load_config
+from .daemon import WatchDaemon, daemon_status
+from .deleter import archive_devices, clear_file_not_from_catalog, del_backups
+from .finish import finish_run
+from .metrics import metrics
+from .partition import Partition, lock_run
+from .planner import apply_plan, parse_target_free, plan_removals, write_plan
+from .simulate import RetentionPolicy, simulate_retention
+from .snapshot import write_snapshot
+from .util import format_exception, peak_rss_mb
+
+
+def usage():
+    print("""Usage: %s [options]
+
+Deletes purged volumes from disk and catalog, see README.md.
+
+  -h, --help              show this help
+  --snapshot=FILE         export the catalog data the planner needs to FILE and exit
+  --from-snapshot=FILE    read the catalog from a snapshot instead of the database,
+                          deletion only with snapshots newer than snapshot_max_age
+  --full                  decide on every purged volume again instead of reusing
+                          the decisions of unchanged chains from checkpoint_file
+  --target-free=SIZE      only delete the largest removable volumes until each
+                          filesystem has SIZE free, like 500G or 15%%
+  --plan=FILE             write the volumes to delete to FILE instead of deleting
+  --apply=FILE            delete the volumes planned in FILE that are still purged,
+                          resuming from FILE.journal
+  --client=NAMES, --pool=NAMES, --storage=NAMES
+                          only decide on the chains of these clients and the purged
+                          volumes in these pools and storages, comma separated
+  --shard=I/N             only decide on the I-th of N shards of the backup chains,
+                          runs on different shards can go side by side
+  --simulate=DAYS --policy=FILE [--report=FILE]
+                          replay the last DAYS of job history under the retention
+                          policy in FILE and show what would have been deleted
+  --daemon                keep running, poll the catalog every daemon_poll_interval
+                          seconds and delete volumes as they become removable
+  --status                show the status of the daemon, exit 1 unless it is healthy
+  -n, --dry-run           only show what would be deleted
+  --no-dry-run            delete, whatever dry_run is set to
+  --dir-conf=FILE, --sd-conf=FILE, --storages-conf=FILE
+                          read these config files instead of the configured ones
+  --state-dir=DIR         keep volume_cache_file, checkpoint_file, config_cache_file,
+                          the lock files and daemon_socket in DIR
+  --metrics=FILE          write timings and counters of the run as JSON to FILE
+  --textfile=FILE         write them for the node_exporter textfile collector to FILE
+""" % os.path.basename(sys.argv[0]))
+
+
+def main(argv=None):
+    """Runs the command with argv, sys.argv by default, returns the exit status."""
+    snapshot_file = None
+    from_snapshot = None
+    full_run = False
+    plan_file = None
+    apply_file = None
+    simulate_days = None
+    policy = None
+    policy_file = None
+    report_file = None
+    target = None
+    clients, pools, storages, shard = (list(), list(), list(), None)
+    daemon = False
+    status = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'hn',
+                                   ['help', 'snapshot=', 'from-snapshot=', 'full', 'dry-run', 'no-dry-run',
+                                    'dir-conf=', 'sd-conf=', 'storages-conf=', 'state-dir=', 'metrics=', 'textfile=', 'target-free=',
+                                    'plan=', 'apply=', 'simulate=', 'policy=', 'report=',
+                                    'client=', 'pool=', 'storage=', 'shard=', 'daemon', 'status'])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        return 2
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            return 0
+        elif opt == '--snapshot':
+            snapshot_file = val
+        elif opt == '--from-snapshot':
+            from_snapshot = val
+        elif opt == '--full':
+            full_run = True
+        elif opt in ('-n', '--dry-run'):
+            config.dry_run = True
+        elif opt == '--no-dry-run':
+            config.dry_run = False
+        elif opt == '--dir-conf':
+            config.dir_conf = val
+        elif opt == '--sd-conf':
+            config.sd_conf = val
+        elif opt == '--storages-conf':
+            config.storages_conf = val
+        elif opt == '--state-dir':
+            config.volume_cache_file = os.path.join(val, os.path.basename(config.volume_cache_file))
+            config.checkpoint_file = os.path.join(val, os.path.basename(config.checkpoint_file))
+            config.config_cache_file = os.path.join(val, os.path.basename(config.config_cache_file))
+            config.lock_dir = val
+            config.daemon_socket = os.path.join(val, os.path.basename(config.daemon_socket))
+        elif opt == '--metrics':
+            config.metrics_json_file = val
+        elif opt == '--textfile':
+            config.metrics_textfile = val
+        elif opt == '--target-free':
+            config.target_free = val
+        elif opt == '--plan':
+            plan_file = val
+        elif opt == '--apply':
+            apply_file = val
+        elif opt == '--simulate':
+            simulate_days = val
+        elif opt == '--policy':
+            policy_file = val
+        elif opt == '--report':
+            report_file = val
+        elif opt in ('--client', '--pool', '--storage'):
+            names = [x.strip() for x in val.split(',') if x.strip()]
+            {'--client': clients, '--pool': pools, '--storage': storages}[opt].extend(names)
+        elif opt == '--shard':
+            try:
+                shard = Partition.parse_shard(val)
+            except ValueError as e:
+                print('Invalid --shard %s: %s' % (val, e))
+                return 2
+        elif opt == '--daemon':
+            daemon = True
+        elif opt == '--status':
+            status = True
+    partition = Partition(clients, pools, storages, shard)
+
+    if apply_file and (plan_file or from_snapshot or snapshot_file):
+        print('--apply checks the plan against the catalog, it goes without --plan and snapshots')
+        return 2
+    if apply_file and partition:
+        print('--apply deletes what the plan holds, partitions are chosen when planning')
+        return 2
+
+    if daemon and (snapshot_file or from_snapshot or plan_file or apply_file or simulate_days):
+        print('--daemon watches the catalog database and deletes, it goes without snapshots, plans and simulations')
+        return 2
+
+    if status:
+        path = partition.state_file(config.daemon_socket)
+        try:
+            state = json.loads(daemon_status(path))
+        except (IOError, OSError, ValueError) as e:
+            print('No daemon on %s: %s' % (path, e))
+            return 1
+        print(json.dumps(state, indent=2, sort_keys=True))
+        return 0 if state.get('healthy') else 1
+
+    if simulate_days:
+        try:
+            simulate_days = int(simulate_days)
+            policy = RetentionPolicy.load(policy_file)
+        except (TypeError, IOError, ValueError) as e:
+            print('--simulate needs a number of days and --policy=FILE: %s' % e)
+            return 2
+
+    if config.target_free:
+        try:
+            target = parse_target_free(config.target_free)
+        except ValueError as e:
+            print('Invalid --target-free %s: %s' % (config.target_free, e))
+            return 2
+
+    util.ISCOLOR = os.environ.get('TERM', '') == 'xterm'
+    metrics.reset()
+    if daemon:
+        return WatchDaemon(partition, target).run()
+    return run(snapshot_file, from_snapshot, full_run, plan_file, apply_file,
+               simulate_days, policy, report_file, target, partition)
+
+
+def run(snapshot_file=None, from_snapshot=None, full_run=False, plan_file=None, apply_file=None,
+        simulate_days=None, policy=None, report_file=None, target=None, partition=None):
+    """One run with the settings in config, returns the exit status.
+
+    A run that deletes holds the locks of its partition until it is done."""
+    partition = partition or Partition()
+    # Dry runs, plans and simulations delete nothing
+    read_only = config.dry_run or bool(plan_file) or bool(simulate_days)
+    locks = list()
+    if not (read_only or snapshot_file) and config.lock_dir:
+        try:
+            locks = lock_run(partition)
+        except (IOError, OSError) as e:
+            print('Can not lock %s: %s' % (config.lock_dir, e))
+            return 1
+        if locks is None:
+            print("Exiting, because another run is deleting volumes of partition %s or one overlapping it." % partition.describe())
+            return 0
+    try:
+        return run_steps(snapshot_file, from_snapshot, full_run, plan_file, apply_file,
+                         simulate_days, policy, report_file, target, partition, read_only)
+    finally:
+        for lock in locks:
+            lock.close()
+
+
+def run_steps(snapshot_file, from_snapshot, full_run, plan_file, apply_file,
+              simulate_days, policy, report_file, target, partition, read_only):
+    if partition:
+        print("Partition %s\n" % partition.describe())
+
+    metrics.start_phase('config_parse')
+    bareos_config = load_config()
+
+    # A run from a snapshot that deletes nothing doesn't need the director
+    metrics.start_phase('service_check')
+    if not (snapshot_file or (from_snapshot and read_only)) and not director_running(bareos_config.director):
+        print("Exiting, because dependent services [bareos-dir] are down.")
+        return 0
+
+    metrics.start_phase('catalog_load')
+    started = time.time()
+    try:
+        catalog = load_catalog(bareos_config, from_snapshot)
+        if from_snapshot:
+            print("Using snapshot %s of catalog %s created %s\n" % (
+                  from_snapshot, catalog.identity.get('catalog'), datetime.fromtimestamp(catalog.created)))
+        if snapshot_file:
+            write_snapshot(catalog, snapshot_file)
+            return 0
+        if apply_file:
+            metrics.start_phase('apply')
+            try:
+                apply_plan(apply_file, catalog)
+            except (IOError, ValueError, KeyError) as e:
+                print("Can not apply plan %s: %s" % (apply_file, e))
+                return 1
+            finish_run()
+            return 0
+        jobs = catalog.iter_jobs(partition.clients)
+        if partition.shard:
+            jobs = (job for job in jobs if partition.chain(job.clientname, job.fileset))
+        chains = ChainIndex(jobs)
+        catalog_volnames = catalog.purged_volnames_with_jobs()
+        purged_vols = catalog.purged_volumes(partition.pools, partition.storages)
+    except Exception as e:
+        print(format_exception(e))
+        print("DATABASE unavailable")
+        return 0
+    if from_snapshot and not read_only and catalog.age() > config.snapshot_max_age:
+        print("Exiting, because snapshot %s is %ds old, only snapshots up to %ds old are used for deletion." % (
+              from_snapshot, catalog.age(), config.snapshot_max_age))
+        return 1
+    if from_snapshot and not read_only and catalog.identity.get('catalog') != config.my_catalog_name:
+        print("Exiting, because snapshot %s is of catalog %s, not %s." % (
+              from_snapshot, catalog.identity.get('catalog'), config.my_catalog_name))
+        return 1
+    print("Loaded %d jobs of %d backup chains and %d purged volumes in %.2fs, peak RSS %.1f MB\n" % (
+          chains.size, len(chains.chains), len(purged_vols), time.time() - started, peak_rss_mb()))
+
+    if simulate_days:
+        metrics.start_phase('simulate')
+        simulate_retention(chains, catalog, policy, simulate_days,
+                           catalog.created if from_snapshot else time.time(), report_file)
+        finish_run()
+        return 0
+
+    remove_backup, remove_reasons, volume_storages = plan_removals(
+        chains, purged_vols, catalog_volnames, bareos_config.storage_dirs, full_run, target, partition)
+
+    if plan_file:
+        print("\n\nDecisions made.")
+        write_plan(plan_file, remove_backup, volume_storages, remove_reasons, catalog)
+        finish_run()
+        return 0
+
+    metrics.start_phase('deletion')
+    print("\n\nDecisions made. Initating deletion.")
+    del_backups(remove_backup, volume_storages)
+    print_bconsole_results(flush_bconsole())
+
+    if not partition.catalog_wide():
+        finish_run()
+        return 0
+
+    if config.check_orphans:
+        metrics.start_phase('orphans')
+        print("\n\nDeleting volumes that are not present in the catalog")
+        try:
+            media_volnames = catalog.media_volnames()
+        except Exception as e:
+            print(format_exception(e))
+            print("DATABASE unavailable")
+            return 0
+        clear_file_not_from_catalog(archive_devices(bareos_config.sd), media_volnames)
+
+    metrics.start_phase('failed_recycle_check')
+    try:
+        volumes = catalog.failed_volumes()
+        recycles = catalog.recycle_volumes()
+    except Exception as e:
+        print(format_exception(e))
+        print("DATABASE unavailable")
+        return 0
+
+    if len(volumes):
+        print("\nWe have some failed volumes (Used but never set Purged cuz LastWritten = 0000-00-00 00:00:00)")
+        print("Run in bconsole:\npurge yes volume=<VolumeName>")
+        print('{0:<50} {1:<8} {2:<19}'.format('VolumeName', 'VolBytes', 'LabelDate'))
+        print("-----------------------------------------------------------------------------------------------------------------------")
+        for vol in volumes:
+            print('{0:<50} {1:<8} {2}'.format(vol['VolumeName'], vol['VolBytes'], vol['LabelDate']))
+            if vol['VolBytes'] < 260:
+                bconsole_purge_volume(vol['VolumeName'])
+
+    if len(recycles):
+        print("\nWe have recycles=YES volumes, you must make it recycles=NO")
+        print("After update you configs, run in bconsole:\nupdate volume\nSelect 14: All Volumes from all Pools")
+        print('{0:<50} {1:<8} {2:<19}'.format('VolumeName', 'VolBytes', 'LabelDate'))
+        print("-----------------------------------------------------------------------------------------------------------------------")
+        for vol in recycles:
+            print('{0:<50} {1:<8} {2}'.format(vol['VolumeName'], vol['VolBytes'], vol['LabelDate']))
+
+    finish_run()
+    return 0
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Bareos config files."""
+
+import glob
+import json
+import os
+import re
+
+from . import config
+from .util import bcolors, find_mount_point, print_color
+
+
+def conf_key(name):
+    """Bareos matches directive and resource names without regard to case and spaces."""
+    return name.replace(' ', '').lower()
+
+
+class Resource(dict):
+    """A resource of a Bareos config.
+
+    Directives are looked up like Bareos does, 'ArchiveDevice' finds the
+    value of 'Archive Device'. The type is in 'thing', resources nested in
+    this one are lists of Resources under their type."""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.names = dict()
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def _key(self, key):
+        return self.names.get(conf_key(key), key)
+
+    def __setitem__(self, key, value):
+        self.names[conf_key(key)] = key
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, self._key(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self._key(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self._key(key), default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+def to_resource(obj):
+    """Turns a resource read back from JSON into a Resource."""
+    res = Resource()
+    for key, value in obj.items():
+        if isinstance(value, list):
+            value = [to_resource(x) if isinstance(x, dict) else x for x in value]
+        res[key] = value
+    return res
+
+
+def conf_get(obj, name, default=None):
+    """Value of a directive of a Resource, which may be None."""
+    if obj is None:
+        return default
+    return obj.get(name, default)
+
+
+def index_resources(resources, *things):
+    """{name: resource} of the resources of these types, the last of a name wins."""
+    wanted = set(conf_key(thing) for thing in things)
+    return dict((conf_get(x, 'Name'), x) for x in resources
+                if conf_key(x['thing']) in wanted and conf_get(x, 'Name'))
+
+
+def conf_values(obj, key):
+    """All values of a directive, repeated or comma separated, without quotes."""
+    values = obj.get(key, [])
+    if not isinstance(values, list):
+        values = [values]
+    return [v.strip('" ') for value in values for v in re.split(r'\s*,\s*', value) if v.strip('" ')]
+
+
+def storage_archive_dirs(devices, storages):
+    """Maps every Storage name to the Archive Devices of its devices.
+
+    devices and storages are {name: resource} of the SD Devices and
+    Autochangers and of the Storages. A Storage may name several devices and
+    a device may be an Autochanger, whose devices are used instead. Returns
+    {storagename: [(path, mounted)]}."""
+    mounted = dict()
+    storage_dirs = dict()
+    for storagename, storage in storages.items():
+        dirs = storage_dirs.setdefault(storagename, list())
+        todo = conf_values(storage, 'Device')
+        seen = set()
+        while todo:
+            devicename = todo.pop(0)
+            device = devices.get(devicename)
+            if device is None or devicename in seen:
+                continue
+            seen.add(devicename)
+            if conf_key(device['thing']) == 'autochanger':
+                todo.extend(conf_values(device, 'Device'))
+                continue
+            path = conf_get(device, 'Archive Device')
+            if not path or path in [d for d, m in dirs]:
+                continue
+            if path not in mounted:
+                mounted[path] = find_mount_point(path) != "/"
+            dirs.append((path, mounted[path]))
+    return storage_dirs
+
+
+def build_volpath(volname, storagename, storage_dirs):
+    """Returns the path of volname in the Archive Devices of the storage.
+
+    With several devices the one holding the volume wins, else the first one.
+    None if a device isn't mounted and the volume isn't found elsewhere, so a
+    volume on an unmounted disk is never taken as missing."""
+    dirs = storage_dirs.get(storagename, [])
+    for path, mounted in dirs:
+        volpath = os.path.join(path, volname)
+        if mounted and os.path.isfile(volpath):
+            return volpath
+    if dirs and all(mounted for path, mounted in dirs):
+        return os.path.join(dirs[0][0], volname)
+
+
+conf_token_re = re.compile(r'"(?:[^"\\]|\\.)*"?|[{};#]|[^"{};#]+')
+
+
+def conf_statements(line):
+    """Splits a config line at braces and semicolons outside of quotes, without the comment."""
+    pieces = list()
+    current = ''
+    for token in conf_token_re.findall(line):
+        if token == '#':
+            break
+        if token in ('{', '}', ';'):
+            pieces.append(current)
+            pieces.append(token)
+            current = ''
+        else:
+            current += token
+    pieces.append(current)
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+
+def add_directive(obj, statement):
+    key, value = re.match(r'([^=]+)=\s*(.*)$', statement).groups()
+    v = re.match(r'"(.*)"', value)
+    if v:
+        value = v.group(1)
+    key = key.strip()
+    # A repeated directive becomes a list of values
+    if key in obj:
+        if not isinstance(obj[key], list):
+            obj[key] = [obj[key]]
+        obj[key].append(value)
+    else:
+        obj[key] = value
+
+
+def parse_conf(lines):
+    """Parses config lines into a list of Resources.
+
+    Resources nested in another one, like the Include and Options blocks of
+    a FileSet, are kept in a list under their type in the enclosing one."""
+    parsed = []
+    stack = []
+    name = None
+    for line in lines:
+        for statement in conf_statements(line):
+            if statement == '{':
+                obj = Resource(thing=name or '')
+                if stack:
+                    nested = stack[-1].setdefault(obj['thing'], list())
+                    if not isinstance(nested, list):
+                        stack[-1][obj['thing']] = nested = [nested]
+                    nested.append(obj)
+                else:
+                    parsed.append(obj)
+                stack.append(obj)
+                name = None
+            elif statement == '}':
+                if stack:
+                    stack.pop()
+                name = None
+            elif statement == ';':
+                continue
+            elif '=' in statement:
+                if stack:
+                    add_directive(stack[-1], statement)
+                name = None
+            else:
+                # The type of the resource that the next brace opens
+                name = statement
+    return parsed
+
+
+def conf_stamp(path, stamps):
+    st = os.stat(path)
+    stamps[path] = [st.st_size, st.st_mtime, st.st_ino]
+
+
+def conf_files(path, stamps):
+    """The files of a config, a single file or a directory in the
+    <daemon>.d/<resource>/*.conf layout. Like Bareos the directory is also
+    used when only it exists next to where the file would be."""
+    if not os.path.exists(path) and os.path.isdir(os.path.splitext(path)[0] + '.d'):
+        path = os.path.splitext(path)[0] + '.d'
+    if not os.path.isdir(path):
+        return [path]
+    # A new file changes the mtime of its directory
+    conf_stamp(path, stamps)
+    for resource_dir in sorted(glob.glob(os.path.join(path, '*'))):
+        if os.path.isdir(resource_dir):
+            conf_stamp(resource_dir, stamps)
+    return sorted(glob.glob(os.path.join(path, '*', '*.conf')))
+
+
+max_include_depth = 20
+
+
+def read_conf_lines(path, stamps, depth=0):
+    """Yields the lines of a config file with its @includes in their place.
+
+    Relative includes are taken from the directory of the including file,
+    patterns include every matching file. Every file read and every directory
+    an include pattern matched in gets its stat in stamps."""
+    if depth > max_include_depth:
+        raise ValueError('@include nested deeper than %d levels in %s' % (max_include_depth, path))
+    with open(path, 'r') as f:
+        conf_stamp(path, stamps)
+        for line in f:
+            include = line.strip()
+            if not include.startswith('@'):
+                yield line
+                continue
+            include = include[1:].strip().strip('"')
+            if include.startswith('|'):
+                print_color(bcolors.WARNING, 'Ignoring @| include of a program output in %s' % path)
+                continue
+            include = os.path.normpath(os.path.join(os.path.dirname(path), include))
+            if re.search(r'[*?[]', include):
+                included = sorted(glob.glob(include))
+                for include_dir in set(os.path.dirname(x) for x in included):
+                    conf_stamp(include_dir, stamps)
+                if not re.search(r'[*?[]', os.path.dirname(include)) and os.path.isdir(os.path.dirname(include)):
+                    conf_stamp(os.path.dirname(include), stamps)
+            else:
+                included = [include]
+            for include in included:
+                for line in read_conf_lines(include, stamps, depth + 1):
+                    yield line
+
+
+class ConfigCache(object):
+    """Parsed configs kept between runs.
+
+    Entries are keyed by config path and hold its resources with the stat of
+    every file and directory they were read from, they are only used while
+    none of those changed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.parsed = dict()
+        self.changed = False
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                print_color(bcolors.WARNING, 'Ignoring broken config cache %s' % path)
+
+    @staticmethod
+    def _valid(stamps):
+        for path, stamp in stamps.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if stamp != [st.st_size, st.st_mtime, st.st_ino]:
+                return False
+        return True
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if not entry or not self._valid(entry['stamps']):
+            return None
+        if path not in self.parsed:
+            self.parsed[path] = [to_resource(x) for x in entry['resources']]
+        return self.parsed[path]
+
+    def put(self, path, stamps, resources):
+        self.entries[path] = {'stamps': stamps, 'resources': resources}
+        self.parsed[path] = resources
+        self.changed = True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        # The resources hold the catalog and director passwords, only the owner may read them
+        tmp = self.path + '.tmp'
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, self.path)
+        self.changed = False
+
+
+conf_cache = None
+
+
+def get_conf_cache():
+    """The config cache of this process, read from config_cache_file once."""
+    global conf_cache
+    if conf_cache is None or conf_cache.path != config.config_cache_file:
+        conf_cache = ConfigCache(config.config_cache_file)
+    return conf_cache
+
+
+def read_conf(path, cache=None):
+    """Returns the resources of a config file or directory with all its includes."""
+    path = os.path.abspath(path)
+    if cache is not None:
+        parsed = cache.get(path)
+        if parsed is not None:
+            return parsed
+    stamps = dict()
+    parsed = list()
+    for conf_file in conf_files(path, stamps):
+        # Every file by itself, a missing brace doesn't swallow the next one
+        parsed.extend(parse_conf(read_conf_lines(conf_file, stamps)))
+    if cache is not None:
+        cache.put(path, stamps, parsed)
+    return parsed
+
+
+class BareosConfig(object):
+    """The resources of the director and storage daemon configs, indexed by name.
+
+    Storages are the ones of the director config and of storages_conf."""
+
+    def __init__(self, dir_resources, sd_resources, storage_resources=(), catalog_name=None):
+        self.dir = dir_resources
+        self.sd = sd_resources
+        self.catalogs = index_resources(dir_resources, 'Catalog')
+        self.storages = index_resources(list(dir_resources) + list(storage_resources), 'Storage')
+        self.devices = index_resources(sd_resources, 'Device', 'Autochanger')
+        self.catalog = self.catalogs.get(catalog_name or config.my_catalog_name)
+        directors = [x for x in dir_resources if conf_key(x['thing']) == 'director']
+        self.director = directors[0] if directors else Resource()
+        self.working_dir = conf_get(self.director, 'WorkingDirectory')
+        self.storage_dirs = storage_archive_dirs(self.devices, self.storages)
+
+
+def load_config(dir_conf=None, sd_conf=None, storages_conf=None, catalog_name=None):
+    """Reads the configs, by default the ones in config, through the config cache."""
+    cache = get_conf_cache()
+    storages_conf = storages_conf or config.storages_conf
+    bareos_config = BareosConfig(read_conf(dir_conf or config.dir_conf, cache),
+                                 read_conf(sd_conf or config.sd_conf, cache),
+                                 read_conf(storages_conf, cache) if storages_conf else [],
+                                 catalog_name)
+    try:
+        cache.save()
+    except (IOError, OSError) as e:
+        print_color(bcolors.WARNING, 'Can not save config cache %s: %s' % (config.config_cache_file, e))
+    return bareos_config
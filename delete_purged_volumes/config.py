@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Settings of a run, the command and the script wrapper change them before running."""
+
+dry_run = True
+#dry_run = True
+is_debug = False
+my_catalog_name = 'MyCatalog'
+# Config files, or directories in the <daemon>.d/<resource>/*.conf layout,
+# @includes are followed. Storages are read from the director config and from
+# storages_conf, None if they are all in the director config
+sd_conf, storages_conf, dir_conf = ('/usr/local/etc/bareos/bareos-sd.conf', None, '/usr/local/etc/bareos/bareos-dir.conf')
+levels = {'I': 'incr', 'D': 'diff', 'F': 'full'}
+# Parsed configs, reused while none of their files changed
+config_cache_file = '/var/db/bareos/delete_purged_volumes.conf.cache'
+# Volume scanning: bls processes in total / per filesystem, bls timeout bounds
+# in seconds and the cache of parsed volumes kept between runs
+scan_workers = 8
+scan_workers_per_mount = 4
+bls_timeout_min, bls_timeout_max, bls_timeout_factor = (0.5, 30.0, 3.0)
+volume_cache_file = '/var/db/bareos/delete_purged_volumes.cache'
+# Read volume labels without bls where the label format is known
+native_label_reader = True
+# One bconsole process runs all delete/purge commands, written in batches
+bconsole_cmd = ['bconsole']
+bconsole_batch_size = 50
+# A command bconsole doesn't answer within this many seconds counts as a lost connection
+bconsole_timeout = 300
+# Files are unlinked by this many threads per filesystem, filesystems in parallel
+delete_workers_per_mount = 1
+# Volumes bigger than delete_chunk_size are shrunk from the end chunk by chunk
+# before the unlink, by ftruncate or with delete_punch_hole by punching holes.
+# All delete workers together free at most delete_rate_limit bytes per second
+# (None for no limit) and run with the ionice arguments in delete_ionice,
+# e.g. ['-c', '3'] for the idle class
+delete_chunk_size = 1024 ** 3
+delete_punch_hole = False
+delete_rate_limit = None
+delete_ionice = None
+# Report files in the Archive Devices that are not volumes in the catalog,
+# delete them too (honoring dry_run) if not modified for orphan_min_age seconds
+check_orphans = False
+delete_orphans = False
+orphan_min_age = 86400
+# Snapshots older than this many seconds are refused when dry_run is off
+snapshot_max_age = 3600
+# Decisions per backup chain, reused while a chain doesn't change
+checkpoint_file = '/var/db/bareos/delete_purged_volumes.state'
+# Runs that delete lock files in lock_dir, so runs side by side on partitions
+# (--client, --pool, --storage, --shard) never work on the same volumes and
+# write to the catalog one at a time, None to not lock
+lock_dir = '/var/db/bareos'
+# --daemon polls the catalog every daemon_poll_interval seconds and serves its
+# status on the UNIX socket daemon_socket, None for no socket
+daemon_poll_interval = 60
+daemon_socket = '/var/db/bareos/delete_purged_volumes.sock'
+# Run summary as JSON and for the node_exporter textfile collector, None to skip
+metrics_json_file = None
+metrics_textfile = None
+# Only delete until every filesystem with purged volumes has this much free
+# space, in bytes ('500G') or percent of its size ('15%'), None deletes all
+target_free = None
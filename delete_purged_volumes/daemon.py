@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Watching the catalog and deleting purged volumes as they become removable."""
+
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime
+
+from . import config
+from .bconsole import director_running, flush_bconsole, print_bconsole_results
+from .catalog import load_catalog
+from .chains import ChainIndex
+from .conf import build_volpath, load_config
+from .deleter import del_backups
+from .finish import finish_run
+from .metrics import metrics
+from .partition import Partition, lock_run
+from .planner import plan_removals, volume_entry
+from .scan import VolumeCache, scan_volumes
+from .util import bcolors, format_exception, print_color
+
+
+class ChangedChains(Partition):
+    """The chains of a partition that changed since the last poll.
+
+    Those are the chains of the changed clients, and the newly purged
+    volumes without a readable label."""
+
+    def __init__(self, partition, clients, volnames):
+        if partition.clients is not None:
+            clients = set(clients) & set(partition.clients)
+        Partition.__init__(self, clients, partition.pools, partition.storages, partition.shard)
+        self.clients = sorted(clients)
+        self.partition = partition
+        self.volnames = volnames
+
+    def __bool__(self):
+        return True
+
+    def unlabeled(self, volname):
+        return volname in self.volnames and self.partition.unlabeled(volname)
+
+
+class WatchDaemon(object):
+    """Deletes purged volumes within a poll interval of becoming removable.
+
+    The catalog connection, the chain index, the configs and the volume cache
+    stay in memory. Every daemon_poll_interval seconds one scan of the Media
+    table tells whether volumes were added, written, purged or deleted and
+    jobs added or pruned, only then the clients with new or pruned jobs or
+    newly purged volumes are looked up and just their chains are loaded and
+    decided again. Volumes on storages that
+    running jobs write to are left for a later poll. The state is served as
+    JSON on the UNIX socket daemon_socket."""
+
+    def __init__(self, partition=None, target=None):
+        self.partition = partition or Partition()
+        self.target = target
+        self.stopping = threading.Event()
+        self.catalog = None
+        self.bareos_config = None
+        self.chains = None
+        self.cache = None
+        self.state = None
+        self.job_counts = dict()
+        self.purged = dict()
+        self.busy = set()
+        # Clients and unlabeled volumes whose deletion was postponed, the
+        # storages that were busy and the other reasons ('director', 'lock')
+        self.pending = None
+        self.status = {
+            'pid': os.getpid(), 'started': time.time(), 'state': 'starting', 'partition': self.partition.describe(),
+            'polls': 0, 'last_poll': None, 'last_change': None, 'errors': 0, 'last_error': None,
+            'volumes_deleted': 0, 'volumes_postponed': 0, 'busy_storages': [], 'chains': 0, 'purged_volumes': 0,
+        }
+
+    def log(self, message):
+        print('[%s] %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message))
+
+    def jobs(self, clients):
+        jobs = self.catalog.iter_jobs(clients)
+        if self.partition.shard:
+            jobs = (job for job in jobs if self.partition.chain(job.clientname, job.fileset))
+        return jobs
+
+    def load(self):
+        """Loads everything, the first poll decides on every chain."""
+        self.cache = VolumeCache(self.partition.state_file(config.volume_cache_file))
+        self.state = self.catalog.media_state()
+        self.job_counts = self.catalog.client_job_counts()
+        self.chains = ChainIndex(self.jobs(self.partition.clients))
+        purged_vols = self.catalog.purged_volumes(self.partition.pools, self.partition.storages)
+        self.purged = dict((x['volname'], x) for x in purged_vols)
+        self.log('Loaded %d jobs of %d backup chains and %d purged volumes' % (
+                 self.chains.size, len(self.chains.chains), len(purged_vols)))
+        return self.partition
+
+    def changes(self):
+        """Returns the ChangedChains since the last poll, None if nothing changed."""
+        state = self.catalog.media_state()
+        if state == self.state:
+            return None
+        clients = set()
+        if state[:2] != self.state[:2] or state[5] != self.state[5]:
+            clients |= self.catalog.clients_written_since(self.state[0], self.state[1], self.state[5])
+        if state[4:] != self.state[4:]:
+            # Pruned jobs leave no trace but the job count of their client
+            job_counts = self.catalog.client_job_counts()
+            clients |= set(c for c in set(job_counts) | set(self.job_counts)
+                           if job_counts.get(c) != self.job_counts.get(c))
+            self.job_counts = job_counts
+        new_vols = list()
+        if state[2:4] != self.state[2:4]:
+            purged_vols = self.catalog.purged_volumes(self.partition.pools, self.partition.storages)
+            new_vols = [x for x in purged_vols if x['volname'] not in self.purged]
+            self.purged = dict((x['volname'], x) for x in purged_vols)
+        self.state = state
+        # The jobs of a newly purged volume leave its chain, its client is on the label
+        volpaths = dict()
+        for x in new_vols:
+            volpath = build_volpath(x['volname'], x['storagename'], self.bareos_config.storage_dirs)
+            if volpath and os.path.isfile(volpath):
+                volpaths[volpath] = x['volname']
+        unlabeled = set(x['volname'] for x in new_vols)
+        for volpath, vol_parsed in scan_volumes(list(volpaths), self.cache).items():
+            if vol_parsed:
+                clients.add(volume_entry(volpath, vol_parsed, ())['client'])
+                unlabeled.discard(volpaths[volpath])
+        changed = ChangedChains(self.partition, clients, unlabeled)
+        if not (changed.clients or unlabeled):
+            return None
+        self.log('%d clients with new or pruned jobs or purged volumes, %d purged volumes without label' % (
+                 len(changed.clients), len(unlabeled)))
+        return changed
+
+    def poll(self):
+        self.bareos_config = load_config()
+        if self.catalog is None:
+            self.catalog = load_catalog(self.bareos_config)
+        # Every poll reads one snapshot and ends it before deleting, so the
+        # next poll sees what was committed since
+        self.catalog.begin_transaction()
+        try:
+            changed = self.read_changes()
+            with_jobs = self.catalog.purged_volnames_with_jobs() if changed is not None else None
+        finally:
+            self.catalog.end_transaction()
+        if changed is not None:
+            self.decide(changed, with_jobs)
+
+    def read_changes(self):
+        """The chains to decide on in this poll with their jobs reloaded, None if none."""
+        changed = self.load() if self.chains is None else self.changes()
+        self.busy = self.catalog.busy_storages()
+        if self.pending is not None and changed is self.partition:
+            self.pending = None
+        elif self.pending is not None and self.pending_ready():
+            clients, volnames = self.pending['clients'], self.pending['volnames']
+            if changed is not None:
+                clients, volnames = clients | set(changed.clients), volnames | changed.volnames
+            changed = ChangedChains(self.partition, clients, volnames)
+            self.pending = None
+        self.status.update(busy_storages=sorted(self.busy), chains=len(self.chains.chains), purged_volumes=len(self.purged))
+        if changed is None:
+            return None
+        self.status['last_change'] = time.time()
+        if changed is not self.partition and changed.clients:
+            self.chains.replace_clients(changed.clients, self.jobs(changed.clients))
+        return changed
+
+    def decide(self, changed, with_jobs):
+        metrics.reset()
+        self.status['state'] = 'deciding'
+        # Only changed chains are decided, a checkpoint of them would hide the others from cron runs
+        remove_backup, reasons, storages = plan_removals(
+            self.chains, list(self.purged.values()), with_jobs,
+            self.bareos_config.storage_dirs, True, self.target, changed, self.cache, False)
+        later = set(volpath for volpath in remove_backup if storages.get(volpath) in self.busy)
+        now = [volpath for volpath in remove_backup if volpath not in later]
+        if later:
+            self.log('Backing off from %d volumes on busy storages %s' % (len(later), ', '.join(sorted(self.busy))))
+            self.postpone(changed, 'busy', set(storages[volpath] for volpath in later))
+        self.status['volumes_postponed'] = len(later)
+        if now:
+            self.delete(now, storages, changed)
+        finish_run()
+
+    def postpone(self, changed, reason, storages=()):
+        """Keeps the chains of changed to decide again once reason is gone."""
+        if changed is self.partition:
+            clients, volnames = set(c for c, f in self.chains.chains), set(self.purged)
+        else:
+            clients, volnames = set(changed.clients), set(changed.volnames)
+        if self.pending is None:
+            self.pending = {'clients': set(), 'volnames': set(), 'storages': set(), 'reasons': set()}
+        self.pending['clients'] |= clients
+        self.pending['volnames'] |= volnames
+        self.pending['storages'] |= set(storages)
+        self.pending['reasons'].add(reason)
+
+    def pending_ready(self):
+        """Whether a reason of the postponed deletions is gone."""
+        reasons = self.pending['reasons']
+        if 'busy' in reasons and self.pending['storages'] - self.busy:
+            return True
+        if 'director' in reasons and director_running(self.bareos_config.director):
+            return True
+        if 'lock' in reasons:
+            locks = lock_run(self.partition)
+            if locks is not None:
+                for lock in locks:
+                    lock.close()
+                return True
+        return False
+
+    def delete(self, remove_backup, storages, changed):
+        locks = list()
+        if not config.dry_run:
+            if not director_running(self.bareos_config.director):
+                self.log('Director is down, deleting later')
+                self.postpone(changed, 'director')
+                return
+            if config.lock_dir:
+                locks = lock_run(self.partition)
+                if locks is None:
+                    self.log('Another run is deleting volumes of partition %s, deleting later' % self.partition.describe())
+                    self.postpone(changed, 'lock')
+                    return
+        self.status['state'] = 'deleting'
+        metrics.start_phase('deletion')
+        try:
+            del_backups(remove_backup, storages)
+            print_bconsole_results(flush_bconsole())
+        finally:
+            for lock in locks:
+                lock.close()
+        self.status['volumes_deleted'] += len(remove_backup)
+        self.log('%s %d volumes' % ('Would delete' if config.dry_run else 'Deleted', len(remove_backup)))
+
+    def healthy(self):
+        last_poll = self.status['last_poll']
+        return last_poll is not None and time.time() - last_poll < 3 * config.daemon_poll_interval
+
+    def serve_status(self, server):
+        """Answers every connection with the status as JSON, 'health' gets OK or STALE."""
+        while not self.stopping.is_set():
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            except (socket.error, OSError):
+                return
+            try:
+                conn.settimeout(1.0)
+                try:
+                    request = conn.recv(64).decode('utf-8', 'replace').strip()
+                except socket.timeout:
+                    request = ''
+                if request == 'health':
+                    reply = 'OK\n' if self.healthy() else 'STALE\n'
+                else:
+                    reply = json.dumps(dict(self.status, healthy=self.healthy()), sort_keys=True) + '\n'
+                conn.sendall(reply.encode('utf-8'))
+            except (socket.error, OSError):
+                pass
+            finally:
+                conn.close()
+
+    def stop(self, signum=None, frame=None):
+        self.stopping.set()
+
+    def run(self):
+        """Polls until SIGTERM or SIGINT, returns the exit status."""
+        handlers = [(signum, signal.signal(signum, self.stop)) for signum in (signal.SIGTERM, signal.SIGINT)]
+        socket_path = self.partition.state_file(config.daemon_socket)
+        server = None
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(socket_path)
+            server.listen(5)
+            server.settimeout(1.0)
+            thread = threading.Thread(target=self.serve_status, args=(server,))
+            thread.daemon = True
+            thread.start()
+        self.log('Watching the catalog every %ds, partition %s' % (config.daemon_poll_interval, self.partition.describe()))
+        try:
+            while not self.stopping.is_set():
+                self.status['state'] = 'polling'
+                try:
+                    self.poll()
+                    self.status['last_poll'] = time.time()
+                except Exception as e:
+                    print(format_exception(e))
+                    print_color(bcolors.FAIL, 'Poll failed, reconnecting to the catalog on the next one')
+                    self.status['errors'] += 1
+                    self.status['last_error'] = '%s: %s' % (type(e).__name__, e)
+                    if self.catalog is not None:
+                        try:
+                            self.catalog.close()
+                        except Exception:
+                            pass
+                    self.catalog = None
+                    self.chains = None
+                self.status['polls'] += 1
+                self.status['state'] = 'backoff' if self.pending else 'idle'
+                self.stopping.wait(config.daemon_poll_interval)
+        finally:
+            self.status['state'] = 'stopping'
+            if server is not None:
+                server.close()
+                os.unlink(socket_path)
+            if self.catalog is not None:
+                self.catalog.close()
+            for signum, handler in handlers:
+                signal.signal(signum, handler)
+        self.log('Stopped')
+        return 0
+
+
+def daemon_status(path, request='status'):
+    """Asks the daemon listening on path, returns its reply."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5.0)
+    try:
+        client.connect(path)
+        client.sendall((request + '\n').encode('utf-8'))
+        reply = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            reply += data
+    finally:
+        client.close()
+    return reply.decode('utf-8')
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Deleting volume files and their catalog entries, and orphaned files."""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from os import scandir
+from queue import Queue
+from subprocess import PIPE, Popen, STDOUT
+
+from . import config
+from .bconsole import flush_bconsole, get_bconsole, print_bconsole_results
+from .metrics import metrics
+from .util import bcolors, debug, find_mount_point, format_size, print_color
+
+
+class IOBudget(object):
+    """Bytes per second shared by all delete workers, a token bucket.
+
+    Workers pay after freeing blocks; the one that overdraws sleeps until the
+    debt is paid back, and so does everyone arriving before that."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate or nbytes <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= nbytes
+            wait = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        if wait:
+            metrics.inc('delete_throttle_seconds', wait)
+            time.sleep(wait)
+
+
+io_budget = None
+ionice_applied = False
+
+
+def get_io_budget():
+    """The I/O budget of this process, ionice is applied when the first files are really deleted."""
+    global io_budget, ionice_applied
+    if io_budget is None:
+        io_budget = IOBudget(config.delete_rate_limit)
+    # A daemon may start out in dry runs
+    if config.delete_ionice and not config.dry_run and not ionice_applied:
+        ionice_applied = True
+        # Threads started afterwards inherit the I/O priority
+        metrics.inc('subprocess_spawns', program='ionice')
+        p = Popen(['ionice'] + list(config.delete_ionice) + ['-p', str(os.getpid())], stdout=PIPE, stderr=STDOUT)
+        out = p.communicate()[0].decode('utf-8', 'replace').strip()
+        if p.returncode:
+            print_color(bcolors.WARNING, 'ionice failed: %s' % out)
+    return io_budget
+
+
+libc = None
+
+
+def punch_hole(fd, offset, length):
+    """fallocate(FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE) on Linux."""
+    global libc
+    import ctypes
+    if libc is None:
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if libc.fallocate(fd, 0x02 | 0x01, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def shrink_volume_file(volpath, budget):
+    """Frees the blocks of a volume file from the end, delete_chunk_size at a time."""
+    punch = config.delete_punch_hole
+    with open(volpath, 'r+b') as f:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        end = st.st_size
+        blocks = st.st_blocks
+        while end > 0:
+            start = max(0, end - config.delete_chunk_size)
+            if punch:
+                try:
+                    punch_hole(fd, start, end - start)
+                except (OSError, AttributeError) as e:
+                    debug('punching holes failed on %s, truncating: %s' % (volpath, e))
+                    punch = False
+            if not punch:
+                os.ftruncate(fd, start)
+            end = start
+            freed_blocks = blocks
+            blocks = os.fstat(fd).st_blocks
+            budget.consume((freed_blocks - blocks) * 512)
+
+
+def remove_volume_file(volpath, budget):
+    """Unlinks a volume file, returns (bytes allocated on disk, error)."""
+    try:
+        size = os.stat(volpath).st_blocks * 512
+    except OSError:
+        size = 0
+    if config.dry_run:
+        return size, None
+    try:
+        if size > config.delete_chunk_size:
+            shrink_volume_file(volpath, budget)
+            size_left = os.stat(volpath).st_blocks * 512
+        else:
+            size_left = size
+        os.remove(volpath)
+        budget.consume(size_left)
+    except Exception as e:
+        return size, e
+    return size, None
+
+
+def del_backups(remove_backup, storages=None, journal=None):
+    """Deletes list of backups from disk and catalog
+
+    Files are removed by a pool of delete_workers_per_mount threads for each
+    filesystem, so separate disks are cleaned at the same time without
+    parallel unlinks hitting one disk. Output and bconsole commands stay in
+    this thread, in the order the files are done.
+    storages maps volpaths to storage names for the reclaimed bytes metric,
+    unlinks and catalog deletes are recorded in journal if given."""
+    by_mount = OrderedDict()
+    for volpath in remove_backup:
+        by_mount.setdefault(find_mount_point(os.path.dirname(volpath)), deque()).append(volpath)
+    done = Queue()
+
+    def bconsole_done(results):
+        print_bconsole_results(results)
+        if journal is not None:
+            for volname, command, ok, out in results:
+                if ok:
+                    journal.record('delete', volname)
+
+    budget = get_io_budget()
+    started = time.time()
+    reclaimed = 0
+
+    def worker(todo):
+        while True:
+            try:
+                volpath = todo.popleft()
+            except IndexError:
+                return
+            done.put((volpath,) + remove_volume_file(volpath, budget))
+
+    workers = [threading.Thread(target=worker, args=(todo,))
+               for todo in by_mount.values() for i in range(min(config.delete_workers_per_mount, len(todo)))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for i in range(len(remove_backup)):
+        volpath, size, error = done.get()
+        volname = os.path.basename(volpath)
+        print('Deleting %s' % volname)
+        print('         %s' % volpath)
+        storage = (storages or {}).get(volpath, '')
+        if config.dry_run:
+            metrics.inc('bytes_reclaimable', size, storage=storage)
+        else:
+            if error is None:
+                metrics.inc('bytes_reclaimed', size, storage=storage)
+                reclaimed += size
+                if journal is not None:
+                    journal.record('unlink', volname)
+            else:
+                print('Already deleted vol %s' % volpath)
+            bconsole_done(get_bconsole().queue(volname, 'delete volume=%s yes' % volname))
+    for w in workers:
+        w.join()
+    if reclaimed:
+        elapsed = time.time() - started
+        print('Reclaimed %s in %.1fs, %s/s' % (format_size(reclaimed), elapsed, format_size(reclaimed / max(elapsed, 0.001))))
+    if not config.dry_run:
+        bconsole_done(flush_bconsole())
+
+
+def archive_devices(sd_conf_parsed):
+    """Returns the Archive Device directories of all mounted SD devices."""
+    dirs = list()
+    for device in sd_conf_parsed:
+        path = device.get('Archive Device')
+        if device['thing'] != 'Device' or not path or path in dirs:
+            continue
+        if not os.path.isdir(path) or find_mount_point(path) == "/":
+            print("Skipping %s, because storage device is not mounted." % path)
+            continue
+        dirs.append(path)
+    return dirs
+
+
+def find_orphan_volumes(backup_dirs, media_volnames):
+    """Returns [(volpath, size, mtime)] of files not known as volumes in the catalog."""
+    orphans = list()
+    for backup_dir in backup_dirs:
+        for entry in scandir(backup_dir):
+            if entry.name.startswith('.') or entry.name in media_volnames:
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            orphans.append((entry.path, st.st_size, st.st_mtime))
+    return orphans
+
+
+def clear_file_not_from_catalog(backup_dirs, media_volnames):
+    """Deleting volumes that are not present in the catalog"""
+    print('Checking for volumes that are not present in the catalog: %s' % ', '.join(backup_dirs))
+    orphans = find_orphan_volumes(backup_dirs, media_volnames)
+    # A volume being labeled right now can be on disk before it is in the catalog
+    too_new = time.time() - config.orphan_min_age
+    count, total = (0, 0)
+    for volpath, size, mtime in sorted(orphans):
+        if mtime > too_new:
+            print('Skipping %s, because it was modified less than %ds ago' % (volpath, config.orphan_min_age))
+            continue
+        count += 1
+        total += size
+        print_color(bcolors.WARNING, '{0:<70} {1:>15}'.format(volpath, size))
+        if config.delete_orphans and not config.dry_run:
+            try:
+                os.remove(volpath)
+            except OSError as e:
+                print('Can not delete %s: %s' % (volpath, e))
+    print('%d files not in catalog, %d bytes reclaimable' % (count, total))
+    if not config.delete_orphans or config.dry_run:
+        print('Set delete_orphans = True and dry_run = False to delete them')
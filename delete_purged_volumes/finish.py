@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""The end of a run of the command or of a daemon poll."""
+
+from . import config
+from .bconsole import close_bconsole, print_bconsole_results
+from .metrics import metrics
+from .util import bcolors, print_color
+
+
+def finish_run():
+    """Closes bconsole, lists its failures and writes the metrics."""
+    results, failed = close_bconsole()
+    print_bconsole_results(results)
+    if failed:
+        print_color(bcolors.FAIL, "\nbconsole commands failed for %d volumes:" % len(failed))
+        for volname, command, out in failed:
+            print_color(bcolors.FAIL, '\t{0:<50} {1}'.format(volname, command))
+
+    metrics.end_phase()
+    for path, write in ((config.metrics_json_file, metrics.write_json), (config.metrics_textfile, metrics.write_textfile)):
+        if not path:
+            continue
+        try:
+            write(path)
+        except (IOError, OSError) as e:
+            print_color(bcolors.WARNING, 'Can not write metrics %s: %s' % (path, e))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Timings and counters of a run."""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import config
+from .util import peak_rss_mb, write_atomic
+
+
+class Metrics(object):
+    """Wall and CPU time per phase and counters of a run.
+
+    Written as a JSON summary and in the Prometheus text format for the
+    node_exporter textfile collector. Counters may be increased from the scan
+    and delete worker threads."""
+
+    prefix = 'bareos_delete_purged_volumes_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Starts over, for the next run in the same process."""
+        self.started = time.time()
+        self.cpu_started = self._cpu()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.phase = None
+
+    @staticmethod
+    def _cpu():
+        t = os.times()
+        return t[0] + t[1], t[2] + t[3]
+
+    def start_phase(self, name):
+        """Ends the running phase and starts timing the next one."""
+        self.end_phase()
+        cpu, cpu_children = self._cpu()
+        self.phase = (name, time.time(), cpu, cpu_children)
+
+    def end_phase(self):
+        if self.phase is None:
+            return
+        name, wall, cpu, cpu_children = self.phase
+        now_cpu, now_cpu_children = self._cpu()
+        self.phases[name] = {'wall': time.time() - wall, 'cpu': now_cpu - cpu,
+                             'cpu_children': now_cpu_children - cpu_children}
+        self.phase = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        self.end_phase()
+        cpu, cpu_children = self._cpu()
+        cpu -= self.cpu_started[0]
+        cpu_children -= self.cpu_started[1]
+        return OrderedDict([
+            ('started', self.started),
+            ('duration', time.time() - self.started),
+            ('cpu', cpu),
+            ('cpu_children', cpu_children),
+            ('peak_rss_bytes', int(peak_rss_mb() * 1048576)),
+            ('dry_run', config.dry_run),
+            ('phases', self.phases),
+            ('counters', [dict(name=name, labels=dict(labels), value=value)
+                          for (name, labels), value in self.counters.items()]),
+        ])
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2) + '\n')
+
+    def write_textfile(self, path):
+        s = self.summary()
+        lines = list()
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s%s %s' % (self.prefix, name, help))
+            lines.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+            for labels, value in samples:
+                label_str = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in sorted(labels.items()))
+                lines.append('%s%s%s %s' % (self.prefix, name, '{%s}' % label_str if label_str else '', repr(float(value))))
+
+        metric('last_run_timestamp_seconds', 'gauge', 'Start of the last run.', [({}, s['started'])])
+        metric('duration_seconds', 'gauge', 'Wall time of the last run.', [({}, s['duration'])])
+        metric('cpu_seconds', 'gauge', 'CPU time of the last run.',
+               [({'process': 'self'}, s['cpu']), ({'process': 'children'}, s['cpu_children'])])
+        metric('peak_rss_bytes', 'gauge', 'Peak resident memory of the last run.', [({}, s['peak_rss_bytes'])])
+        metric('dry_run', 'gauge', '1 if the last run was a dry run.', [({}, int(bool(s['dry_run'])))])
+        metric('phase_seconds', 'gauge', 'Wall time per phase of the last run.',
+               [({'phase': name}, p['wall']) for name, p in s['phases'].items()])
+        metric('phase_cpu_seconds', 'gauge', 'CPU time per phase of the last run.',
+               [({'phase': name}, p['cpu'] + p['cpu_children']) for name, p in s['phases'].items()])
+        names = OrderedDict()
+        for c in s['counters']:
+            names.setdefault(c['name'], list()).append((c['labels'], c['value']))
+        for name, samples in names.items():
+            metric(name, 'gauge', 'Count of the last run.', samples)
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+
+metrics = Metrics()
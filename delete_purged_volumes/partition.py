@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Partitions of the catalog that runs can work on side by side, and their locks."""
+
+import errno
+import fcntl
+import glob
+import json
+import os
+import re
+import zlib
+
+from . import config
+
+
+class Partition(object):
+    """The clients, pools, storages and shard a run is restricted to.
+
+    clients, pools and storages are lists of names, None for all. A shard
+    (i, n) holds the backup chains whose crc32 of client and fileset is i - 1
+    modulo n, so a chain is always decided by one shard as a whole. Clients
+    and shards select chains, pools and storages select the purged volumes
+    that are candidates for deletion."""
+
+    def __init__(self, clients=None, pools=None, storages=None, shard=None):
+        self.clients = sorted(set(clients)) if clients else None
+        self.pools = sorted(set(pools)) if pools else None
+        self.storages = sorted(set(storages)) if storages else None
+        self.shard = shard
+        self.shards = dict()
+
+    def __bool__(self):
+        return bool(self.clients or self.pools or self.storages or self.shard)
+
+    @staticmethod
+    def parse_shard(spec):
+        """'2/4' -> (2, 4)"""
+        m = re.match(r'\s*(\d+)\s*/\s*(\d+)\s*$', spec)
+        if not m:
+            raise ValueError('expected I/N')
+        i, n = int(m.group(1)), int(m.group(2))
+        if not 1 <= i <= n:
+            raise ValueError('shard %d is not one of 1..%d' % (i, n))
+        return i, n
+
+    def chain(self, client, fileset):
+        """Whether the chain of client and fileset is in the partition."""
+        if self.clients is not None and client not in self.clients:
+            return False
+        if self.shard is None:
+            return True
+        key = (client, fileset)
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.shards[key] = zlib.crc32(('%s\0%s' % key).encode('utf-8')) % self.shard[1] + 1
+        return shard == self.shard[0]
+
+    def unlabeled(self, volname):
+        """Whether a volume without a readable label, so without a known
+        chain, is in the partition. Those are spread over the shards by name
+        and left to runs that don't select clients."""
+        if self.clients is not None:
+            return False
+        if self.shard is None:
+            return True
+        return zlib.crc32(volname.encode('utf-8')) % self.shard[1] + 1 == self.shard[0]
+
+    def volume(self, vol):
+        """Whether a purged volume from Catalog.purged_volumes is a candidate."""
+        if self.pools is not None and vol.get('poolname') not in self.pools:
+            return False
+        return self.storages is None or vol['storagename'] in self.storages
+
+    def overlaps(self, other):
+        """Whether two partitions may decide on the same volume: unless both
+        select clients, pools or storages and those are disjoint, or both are
+        different shards of the same number."""
+        for mine, theirs in ((self.clients, other.clients), (self.pools, other.pools),
+                             (self.storages, other.storages)):
+            if mine is not None and theirs is not None and not set(mine) & set(theirs):
+                return False
+        if self.shard and other.shard and self.shard[1] == other.shard[1] and self.shard[0] != other.shard[0]:
+            return False
+        return True
+
+    def to_dict(self):
+        return {'clients': self.clients, 'pools': self.pools, 'storages': self.storages, 'shard': self.shard}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('clients'), d.get('pools'), d.get('storages'), tuple(d['shard']) if d.get('shard') else None)
+
+    def catalog_wide(self):
+        """Whether the run also does the checks of the whole catalog, orphan
+        files and failed or recycled volumes: runs without selectors do, of
+        shards only the first one."""
+        return not (self.clients or self.pools or self.storages) and (self.shard is None or self.shard[0] == 1)
+
+    def describe(self):
+        parts = list()
+        for name, values in (('client', self.clients), ('pool', self.pools), ('storage', self.storages)):
+            if values:
+                parts.append('%s=%s' % (name, ','.join(values)))
+        if self.shard:
+            parts.append('shard=%d/%d' % self.shard)
+        return ' '.join(parts) or 'all'
+
+    def tag(self):
+        """Names the state and lock files of the partition."""
+        if not self:
+            return None
+        if self.shard and not (self.clients or self.pools or self.storages):
+            return 'shard%dof%d' % self.shard
+        return 'part%08x' % (zlib.crc32(self.describe().encode('utf-8')) & 0xffffffff)
+
+    def state_file(self, path):
+        """path of a state file for this partition, each partition keeps its own."""
+        if not path or not self:
+            return path
+        return '%s.%s' % (path, self.tag())
+
+
+def lock_file(path, shared=False, blocking=False):
+    """flocks path, returns the open file holding the lock, None if another process holds it."""
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f.fileno(), (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+    except (IOError, OSError) as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return None
+        raise
+    return f
+
+
+def lock_path(name):
+    return os.path.join(config.lock_dir, 'delete_purged_volumes.%s.lock' % name)
+
+
+def running_partition(path):
+    """The partition of a partition lock file if a run holds it, else None."""
+    f = lock_file(path)
+    if f is not None:
+        f.close()
+        return None
+    try:
+        with open(path, 'r') as f:
+            return Partition.from_dict(json.load(f))
+    except (IOError, ValueError, KeyError, TypeError):
+        # Unreadable, so it could be anything
+        return Partition()
+
+
+def lock_run(partition):
+    """Takes the locks of a deleting run, returns the lock files or None if another run holds them.
+
+    The global run lock is shared by runs on partitions and exclusive for runs
+    on the whole catalog, so those never overlap with any partition. A run on
+    a partition holds a lock file with its selectors and only starts while no
+    running partition overlaps it, checked under the partitions lock so two
+    runs never check at the same time."""
+    run_lock = lock_file(lock_path('run'), shared=bool(partition))
+    if run_lock is None:
+        return None
+    if not partition:
+        return [run_lock]
+    registry = lock_file(lock_path('partitions'), blocking=True)
+    try:
+        for path in glob.glob(lock_path('partition.*')):
+            running = running_partition(path)
+            if running is not None and running.overlaps(partition):
+                run_lock.close()
+                return None
+        partition_lock = lock_file(lock_path('partition.' + partition.tag()))
+        if partition_lock is None:
+            run_lock.close()
+            return None
+        partition_lock.seek(0)
+        partition_lock.truncate()
+        json.dump(partition.to_dict(), partition_lock)
+        partition_lock.flush()
+    finally:
+        registry.close()
+    return [run_lock, partition_lock]
@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+"""Deciding which purged volumes can go, plans and their journal."""
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+from . import config
+from .chains import ChainIndex
+from .deleter import del_backups
+from .metrics import metrics
+from .conf import build_volpath
+from .scan import VolumeCache, print_vol, scan_volumes
+from .snapshot import SnapshotCatalog
+from .util import bcolors, debug, find_mount_point, format_size, print_color, vols2str, write_atomic
+
+
+def decide_full(vol, chains, purged_full_chains):
+    """Decides on a purged full volume, returns (remove, reason)."""
+    name        = vol['vol']
+    backup_time = vol['time']
+    cn          = vol['client']
+    fn          = vol['fileset']
+    chain       = chains.chain(cn, fn)
+    debug('{1:<6} {0:<50}'.format(name, vol['id']))
+    newer_full_backups = chain.newer('F', backup_time)
+    if config.is_debug:
+        debug('newer_full_backups\n%s' % vols2str(newer_full_backups))
+
+    all_full_backups = purged_full_chains.chain(cn, fn).newer('F', backup_time)
+
+    if len(newer_full_backups) == 0 and len(all_full_backups) == 0:
+        print("Skipping and not removing {0}, because it's the newest full backup.".format(name))
+        return False, 'newest-full'
+    if not vol['in_catalog']:
+        print("Remove {0}, because it not found in catalog and NOT the only one newest full backup".format(name))
+        return True, 'not-in-catalog'
+
+    next_full_backup = chain.next_after('F', backup_time)
+    next_full_time = next_full_backup['jobtdate'] if next_full_backup else None
+    debug('next_full_backup\n%s' % vols2str(next_full_backup or []))
+
+    next_full_diff_backup = chain.next_after('FD', backup_time)
+    next_full_diff_time = next_full_diff_backup['jobtdate'] if next_full_diff_backup else None
+    debug('next_full_diff_backup\n%s' % vols2str(next_full_diff_backup or []))
+
+    inc_backups = chain.between('I', backup_time, next_full_diff_time)
+    debug('inc_backups\n%s' % vols2str(inc_backups))
+
+    diff_backups = chain.between('D', backup_time, next_full_time)
+    debug('diff_backups\n%s' % vols2str(diff_backups))
+
+    full_backups = chain.all('F')
+    if config.is_debug:
+        debug('full_backups\n%s' % vols2str(full_backups))
+
+    if len(inc_backups) > 0:
+        print('Not removing {0}, because there are still incremental backups dependent on it.'.format(name))
+        print('inc_backups\n%s' % vols2str(inc_backups))
+        return False, 'incr-dependent'
+    if len(diff_backups) > 0:
+        print('Not removing {0}, because there are still diff backups dependent on it.'.format(name))
+        print('diff_backups\n%s' % vols2str(diff_backups))
+        return False, 'diff-dependent'
+    if len(full_backups) < 1:
+        print('Not removing {0}, because we have less than 1 full backups in total.'.format(name))
+        print('full_backups\n%s' % vols2str(full_backups))
+        return False, 'no-full'
+    if len(all_full_backups)+len(full_backups) < 4:
+        print('Not removing {0}, because we have less than 4 full backups newer this.'.format(name))
+        print('full_backups\n%s' % vols2str(full_backups))
+        return False, 'min-fulls'
+    return True, 'full-unreferenced'
+
+
+def decide_incr(vol, chains):
+    """Decides on a purged incremental volume, returns (remove, reason)."""
+    name        = vol['vol']
+    backup_time = vol['time']
+    chain       = chains.chain(vol['client'], vol['fileset'])
+    debug('{1:<6} {0:<50}'.format(name, vol['id']))
+
+    next_full_diff_backup = chain.next_after('FD', backup_time)
+    debug('next_full_diff_backup\n%s' % vols2str(next_full_diff_backup or []))
+
+    prev_full_diff_backup = chain.prev_before('FD', backup_time)
+    debug('prev_full_diff_backup\n%s' % vols2str(prev_full_diff_backup or []))
+
+    inc_backups = chain.between('I',
+                                prev_full_diff_backup['jobtdate'] if prev_full_diff_backup else None,
+                                next_full_diff_backup['jobtdate'] if next_full_diff_backup else None)
+    debug('inc_backups\n%s' % vols2str(inc_backups))
+
+    if len(inc_backups) > 0:
+        print('Not removing {0}, because there are still chained inc backups that are not purged.'.format(name))
+        print('inc_backups\n%s' % vols2str(inc_backups))
+        return False, 'incr-chained'
+    return True, 'incr-unreferenced'
+
+
+def decide_diff(vol, chains):
+    """Decides on a purged diff volume, returns (remove, reason)."""
+    name        = vol['vol']
+    backup_time = vol['time']
+    chain       = chains.chain(vol['client'], vol['fileset'])
+    debug('{1:<6} {0:<50}'.format(name, vol['id']))
+    next_full_diff_backup = chain.next_after('FD', backup_time)
+    if next_full_diff_backup is None:
+        print('Not removing {0}, because there its latest diff backups.'.format(name))
+        return False, 'latest-diff'
+    debug('next_full_diff_backup %s' % vols2str(next_full_diff_backup))
+
+    inc_backups = chain.between('I', backup_time, next_full_diff_backup['jobtdate'])
+    debug('inc_backups %s' % vols2str(inc_backups))
+
+    if len(inc_backups) > 0:
+        print('Not removing {0}, because there are still incremental backups dependent on it.'.format(name))
+        print('inc_backups %s' % vols2str(inc_backups))
+        return False, 'incr-dependent'
+    '''
+    if chain.count('D') < 1:
+        print('Not removing {0}, because we have less than 1 full backups in total.'.format(name))
+        return False, 'min-diffs'
+    '''
+    return True, 'diff-unreferenced'
+
+
+class Checkpoint(object):
+    """Decisions of the last run, per backup chain.
+
+    A chain is stored with its high-water mark: the number of jobs and the
+    newest jobtdate seen on not purged volumes and the purged volumes found
+    in the chain. New jobs raise the newest jobtdate, pruned ones lower the
+    count and purged volumes change the set, so while the mark of a chain is
+    unchanged its decisions are reused."""
+
+    version = 2
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self.chains = dict()
+        if load and path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+                if state.get('version') == self.version:
+                    self.chains = state['chains']
+            except (IOError, ValueError, KeyError):
+                print_color(bcolors.WARNING, 'Ignoring broken checkpoint %s' % path)
+
+    @staticmethod
+    def key(client, fileset):
+        return '%s\t%s' % (client, fileset)
+
+    @staticmethod
+    def mark(chain, purged):
+        times = [chain.times[level][-1] for level in ('F', 'D', 'I') if chain.times[level]]
+        return {
+            'jobs': chain.count('F') + chain.count('D') + chain.count('I'),
+            'max_jobtdate': max(times) if times else None,
+            # Level and time of a volume come from its label and don't change
+            'purged': sorted([x['vol'], x['in_catalog']] for x in purged),
+        }
+
+    def get(self, key, mark, volname):
+        """Returns (remove, reason) of the last run if the chain is unchanged."""
+        state = self.chains.get(key)
+        if state and state['mark'] == mark and volname in state['decisions']:
+            return tuple(state['decisions'][volname])
+
+    def put(self, key, mark, volname, remove, reason):
+        state = self.chains.setdefault(key, {'mark': mark, 'decisions': dict()})
+        state['decisions'][volname] = [remove, reason]
+
+    def save(self):
+        if not self.path:
+            return
+        write_atomic(self.path, json.dumps({'version': self.version, 'created': time.time(), 'chains': self.chains}))
+
+
+def decide_volumes(vols, decide_fn, checkpoint, new_checkpoint, marks, reasons):
+    """Runs decide_fn on vols or reuses the decision of the checkpoint.
+
+    Returns the volpaths to remove, reasons gets the reason of each one."""
+    remove_backup = list()
+    for vol in vols:
+        key = Checkpoint.key(vol['client'], vol['fileset'])
+        decision = checkpoint.get(key, marks[key], vol['vol']) if checkpoint else None
+        if decision:
+            remove, reason = decision
+            if not remove:
+                print('Not removing {0}, because of {1} (chain unchanged since last run).'.format(vol['vol'], reason))
+        else:
+            remove, reason = decide_fn(vol)
+        new_checkpoint.put(key, marks[key], vol['vol'], remove, reason)
+        metrics.inc('volumes_removed' if remove else 'volumes_kept', reason=reason)
+        if remove:
+            remove_backup.append(vol['volpath'])
+            reasons[vol['volpath']] = reason
+    return remove_backup
+
+
+size_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_target_free(spec):
+    """Parses a free space target, '15%' -> (15.0, True), '500G' -> (536870912000, False)."""
+    spec = spec.strip().upper()
+    if spec.endswith('%'):
+        value = float(spec[:-1])
+        if not 0 < value <= 100:
+            raise ValueError('target percentage out of range: %s' % spec)
+        return value, True
+    unit = spec[-1:]
+    if unit == 'B':
+        spec = spec[:-1]
+        unit = spec[-1:]
+    if unit in size_units:
+        return int(float(spec[:-1]) * size_units[unit]), False
+    return int(spec), False
+
+
+def bytes_to_free(mount, target):
+    """How many bytes must be freed on the filesystem of mount to reach target."""
+    st = os.statvfs(mount)
+    free = st.f_bavail * st.f_frsize
+    value, percent = target
+    wanted = st.f_blocks * st.f_frsize * value / 100.0 if percent else value
+    return max(0, int(wanted - free))
+
+
+def volume_entry(volpath, vol_parsed, catalog_volnames):
+    cn, fn, ts, jl, ji, vol = vol_parsed
+    return {
+          'volpath': volpath
+        , 'client':  cn
+        , 'fileset': fn
+        , 'time':    ts
+        , 'id':      ji
+        , 'vol':     vol
+        , 'level':   jl
+        , 'in_catalog': vol in catalog_volnames
+    }
+
+
+def reclaim_to_target(volpaths, target, cache, chains, catalog_volnames, reasons, partition=None):
+    """Decides on the largest purged volumes first until the target is met.
+
+    Volumes are grouped by filesystem and ranked by the space they take on
+    disk. Each filesystem is scanned and decided in that order, scan_workers
+    volumes at a time, and left alone as soon as the volumes chosen so far
+    free enough. Purged fulls not scanned yet don't count for the minimum of
+    full backups, so a volume is only ever kept that a full run might remove,
+    never the other way round. Volumes of chains outside partition are left
+    alone. Returns the volpaths to remove, reasons gets the reason of each one."""
+    by_mount = dict()
+    for volpath in volpaths:
+        try:
+            size = os.stat(volpath).st_blocks * 512
+        except OSError as e:
+            print_color(bcolors.WARNING, 'Skipping volume, because it can not be ranked: %s' % e)
+            metrics.inc('volumes_skipped', reason='vanished')
+            continue
+        mount = find_mount_point(os.path.dirname(volpath))
+        by_mount.setdefault(mount, list()).append((size, volpath))
+    remove_backup = list()
+    full_purged = list()
+    for mount in sorted(by_mount):
+        ranked = sorted(by_mount[mount], reverse=True)
+        needed = bytes_to_free(mount, target)
+        print('\n%s: %s to free, %d purged volumes with %s on disk\n' % (
+              mount, format_size(needed), len(ranked), format_size(sum(size for size, volpath in ranked))))
+        freed = 0
+        done = 0
+        while freed < needed and done < len(ranked):
+            batch = ranked[done:done + config.scan_workers]
+            done += len(batch)
+            scanned = scan_volumes([volpath for size, volpath in batch], cache)
+            vols = list()
+            for size, volpath in batch:
+                if volpath not in scanned:
+                    continue
+                if scanned[volpath]:
+                    vol = volume_entry(volpath, scanned[volpath], catalog_volnames)
+                    if partition and not partition.chain(vol['client'], vol['fileset']):
+                        metrics.inc('volumes_skipped', reason='other-partition')
+                        continue
+                    vols.append((size, vol))
+                print_vol(volpath, scanned[volpath])
+            full_purged.extend(vol for size, vol in vols if vol['level'] == 'F')
+            purged_full_chains = ChainIndex(full_purged, client_key='client', time_key='time', level_key=None)
+            for size, vol in vols:
+                if freed >= needed:
+                    break
+                if vol['level'] == 'F':
+                    remove, reason = decide_full(vol, chains, purged_full_chains)
+                elif vol['level'] == 'I':
+                    remove, reason = decide_incr(vol, chains)
+                elif vol['level'] == 'D':
+                    remove, reason = decide_diff(vol, chains)
+                else:
+                    print("UNKNOWN BACKUP LVL")
+                    continue
+                metrics.inc('volumes_removed' if remove else 'volumes_kept', reason=reason)
+                if remove:
+                    remove_backup.append(vol['volpath'])
+                    reasons[vol['volpath']] = reason
+                    freed += size
+        if done < len(ranked):
+            metrics.inc('volumes_skipped', len(ranked) - done, reason='target-met')
+        print('\n%s: %s chosen for deletion, target %s, %d of %d volumes scanned\n' % (
+              mount, format_size(freed), 'met' if freed >= needed else 'NOT met', done, len(ranked)))
+    return remove_backup
+
+
+def plan_removals(chains, purged_vols, catalog_volnames, storage_dirs, full_run=False, target=None, partition=None,
+                  cache=None, checkpoint_file=None):
+    """Decides on the purged volumes of the catalog.
+
+    With target, a parse_target_free result, only the largest removable
+    volumes are chosen until it is met, else every one is decided and the
+    decisions of unchanged chains come from the checkpoint unless full_run.
+    With a Partition only volumes of its chains are decided, the labels of
+    all purged volumes are read to know their chain. cache is the
+    VolumeCache to use and checkpoint_file where the decisions are kept,
+    False for nowhere; by default volume_cache_file and checkpoint_file,
+    suffixed with the partition.
+    Returns (remove_backup, reasons, storages): the volpaths to delete, the
+    reason and the storage of each one."""
+    metrics.start_phase('volume_scan')
+    full_purged = list()
+    diff_purged = list()
+    inc_purged = list()
+    remove_backup = list()
+    remove_reasons = dict()
+    volume_storages = dict()
+
+    print("Sorting purged volumes to full_purged, diff_purged and inc_purged.\n")
+    print('{5:<6} {0:<50} {1:<5} {2:<25} {3:<18} {4:<15}'.format('Volume', 'Level', 'Client', 'Created', 'File set', 'JobId'))
+    print("-----------------------------------------------------------------------------------------------------------------------")
+    volpaths = list()
+    for x in purged_vols:
+        if partition and not partition.volume(x):
+            continue
+        volpath = build_volpath(x['volname'], x['storagename'], storage_dirs)
+        try:
+            if not os.path.isfile(volpath):
+                if partition and not partition.unlabeled(x['volname']):
+                    metrics.inc('volumes_skipped', reason='other-partition')
+                    continue
+                print("Deleting backup from catalog, because volume doesn't exist anymore: %s" % volpath)
+                metrics.inc('volumes_removed', reason='missing-on-disk')
+                remove_backup.append(volpath)
+                remove_reasons[volpath] = 'missing-on-disk'
+                volume_storages[volpath] = x['storagename']
+                continue
+        except:
+            print("Skipping this purged volume, because storage device is not mounted.")
+            metrics.inc('volumes_skipped', reason='not-mounted')
+            continue
+        volpaths.append(volpath)
+        volume_storages[volpath] = x['storagename']
+
+    vol_cache = cache or VolumeCache(partition.state_file(config.volume_cache_file) if partition
+                                     else config.volume_cache_file)
+    if checkpoint_file is None:
+        checkpoint_file = partition.state_file(config.checkpoint_file) if partition else config.checkpoint_file
+    if target:
+        # Largest volumes first, scanning and deciding stops once the target is met
+        metrics.start_phase('target_free')
+        remove_backup += reclaim_to_target(volpaths, target, vol_cache, chains, catalog_volnames, remove_reasons,
+                                           partition)
+    else:
+        scanned = scan_volumes(volpaths, vol_cache)
+
+        for volpath in volpaths:
+            if volpath not in scanned:
+                continue
+            vol_parsed = scanned[volpath]
+            if not vol_parsed:
+                print_vol(volpath, vol_parsed)
+                continue
+            x1 = volume_entry(volpath, vol_parsed, catalog_volnames)
+            if partition and not partition.chain(x1['client'], x1['fileset']):
+                metrics.inc('volumes_skipped', reason='other-partition')
+                continue
+            print_vol(volpath, vol_parsed)
+            if x1['level'] == 'F':
+                full_purged.append(x1)
+            elif x1['level'] == 'D':
+                diff_purged.append(x1)
+            elif x1['level'] == 'I':
+                inc_purged.append(x1)
+            else:
+                print("UNKNOWN BACKUP LVL")
+
+        metrics.start_phase('decision_index')
+        purged_full_chains = ChainIndex(full_purged, client_key='client', time_key='time', level_key=None)
+
+        # Only chains that got new jobs or purged volumes since the last run are decided again
+        checkpoint = None if full_run else Checkpoint(checkpoint_file)
+        new_checkpoint = Checkpoint(checkpoint_file, load=False)
+        purged_by_chain = dict()
+        for vol in full_purged + diff_purged + inc_purged:
+            purged_by_chain.setdefault(Checkpoint.key(vol['client'], vol['fileset']), list()).append(vol)
+        marks = dict()
+        for key, vols in purged_by_chain.items():
+            marks[key] = Checkpoint.mark(chains.chain(vols[0]['client'], vols[0]['fileset']), vols)
+
+        metrics.start_phase('decide_full')
+        print("\n\nDeciding which purged full vols to delete\n")
+        remove_backup += decide_volumes(full_purged, lambda vol: decide_full(vol, chains, purged_full_chains),
+                                        checkpoint, new_checkpoint, marks, remove_reasons)
+
+        metrics.start_phase('decide_incr')
+        print("\n\nDeciding which purged incremental vols to delete")
+        remove_backup += decide_volumes(inc_purged, lambda vol: decide_incr(vol, chains),
+                                        checkpoint, new_checkpoint, marks, remove_reasons)
+
+        metrics.start_phase('decide_diff')
+        print("\n\nDeciding which purged diff vols to delete")
+        remove_backup += decide_volumes(diff_purged, lambda vol: decide_diff(vol, chains),
+                                        checkpoint, new_checkpoint, marks, remove_reasons)
+
+        try:
+            new_checkpoint.save()
+        except (IOError, OSError) as e:
+            print_color(bcolors.WARNING, 'Can not save checkpoint %s: %s' % (checkpoint_file, e))
+
+    vol_cache.prune()
+    try:
+        vol_cache.save()
+    except (IOError, OSError) as e:
+        print_color(bcolors.WARNING, 'Can not save volume cache %s: %s' % (vol_cache.path, e))
+    return remove_backup, remove_reasons, volume_storages
+
+
+class Journal(object):
+    """Append-only record of an apply, one fsynced line per finished step.
+
+    Lines are "unlink<TAB>volume" once the file is gone and
+    "delete<TAB>volume" once bconsole deleted it from the catalog."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    # A torn last line of a killed run is ignored
+                    if line.endswith('\n') and '\t' in line:
+                        self.done.add(tuple(line.rstrip('\n').split('\t', 1)))
+        self.f = open(path, 'a')
+
+    def record(self, action, volname):
+        self.f.write('%s\t%s\n' % (action, volname))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.done.add((action, volname))
+
+    def close(self):
+        self.f.close()
+
+
+plan_version = 1
+
+
+def write_plan(path, remove_backup, storages, reasons, catalog):
+    """Writes the volumes to remove and why, for --apply."""
+    volumes = list()
+    for volpath in remove_backup:
+        try:
+            st = os.stat(volpath)
+            size, mtime = st.st_blocks * 512, st.st_mtime
+        except OSError:
+            size, mtime = 0, None
+        volumes.append(OrderedDict([('volume', os.path.basename(volpath)), ('path', volpath), ('size', size),
+                                    ('mtime', mtime), ('rule', reasons.get(volpath)), ('storage', storages.get(volpath))]))
+    snapshot = None
+    if isinstance(catalog, SnapshotCatalog):
+        snapshot = {'path': catalog.path, 'created': catalog.created}
+    plan = OrderedDict([('version', plan_version), ('created', time.time()), ('catalog', catalog.identity),
+                        ('snapshot', snapshot), ('volumes', volumes)])
+    write_atomic(path, json.dumps(plan, indent=1) + '\n')
+    print('Plan with %d volumes, %s on disk, written to %s' % (
+          len(volumes), format_size(sum(x['size'] for x in volumes)), path))
+
+
+def apply_plan(path, catalog):
+    """Deletes the volumes of a plan, resuming from its journal.
+
+    A volume is only acted on while it is still Purged in the catalog and its
+    file, if still there, is the one that was planned; volumes the journal
+    has as deleted are skipped."""
+    with open(path, 'r') as f:
+        plan = json.load(f)
+    if plan.get('version') != plan_version:
+        raise ValueError('unknown plan version %r' % plan.get('version'))
+    if plan['catalog'].get('catalog') != config.my_catalog_name:
+        raise ValueError('plan is of catalog %s, not %s' % (plan['catalog'].get('catalog'), config.my_catalog_name))
+    journal = Journal(path + '.journal')
+    purged = set(x['volname'] for x in catalog.purged_volumes())
+    remove_backup = list()
+    storages = dict()
+    for x in plan['volumes']:
+        if ('delete', x['volume']) in journal.done:
+            metrics.inc('volumes_skipped', reason='already-applied')
+            continue
+        if x['volume'] not in purged:
+            print_color(bcolors.WARNING, 'Skipping %s, because it is not purged anymore' % x['volume'])
+            metrics.inc('volumes_skipped', reason='not-purged')
+            continue
+        try:
+            st = os.stat(x['path'])
+        except OSError:
+            st = None
+        if st is not None and (st.st_blocks * 512 != x['size'] or st.st_mtime != x['mtime']):
+            print_color(bcolors.WARNING, 'Skipping %s, because the file changed since planning' % x['volume'])
+            metrics.inc('volumes_skipped', reason='changed')
+            continue
+        metrics.inc('volumes_removed', reason=x['rule'])
+        remove_backup.append(x['path'])
+        storages[x['path']] = x['storage']
+    print('Applying %d of %d planned volumes\n' % (len(remove_backup), len(plan['volumes'])))
+    try:
+        del_backups(remove_backup, storages, journal)
+    finally:
+        journal.close()
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""Reading job metadata from volume files, natively or with bls."""
+
+import errno
+import json
+import os
+import re
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from queue import Empty, Queue
+from subprocess import PIPE, Popen
+
+from . import config
+from .metrics import metrics
+from .util import bcolors, debug, find_mount_point, print_color, write_atomic
+
+
+bls_field_re = re.compile(r'(JobId|ClientName|FileSet|JobLevel|Date written)\s+:\s(.*?)\r?$')
+
+
+def run_bls(volume, timeout):
+    """Runs bls on volume until the first session label has been printed.
+
+    bls goes on reading the whole volume afterwards, so it is killed as soon as
+    all fields are seen or when timeout expires. Returns (fields, timed_out)."""
+    cmd = ['bls', '-jv', volume]
+    d = dict(os.environ)
+    d['LC_ALL'] = '"en_EN.UTF-8"'
+    metrics.inc('subprocess_spawns', program='bls')
+    with open(os.devnull, 'w') as devnull:
+        p = Popen(cmd, stdout=PIPE, stderr=devnull, env=d)
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        p.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    fields = dict()
+    try:
+        for line in iter(p.stdout.readline, b''):
+            m = bls_field_re.match(line.decode('utf-8', 'replace'))
+            if m and m.group(1) not in fields:
+                if m.group(1) == 'JobId' and not m.group(2).isdigit():
+                    continue
+                fields[m.group(1)] = m.group(2)
+                if len(fields) == 5:
+                    break
+    finally:
+        timer.cancel()
+        if p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        p.wait()
+    if killed.is_set():
+        metrics.inc('bls_timeouts')
+    return fields, killed.is_set()
+
+
+def parse_bls_output(fields, vol):
+    """Returns (cn, fn, ts, jl, ji, vol) from bls fields or None."""
+    try:
+        ji = fields['JobId']
+        cn = fields['ClientName']
+        fn = fields['FileSet']
+        jl = fields['JobLevel']
+        ti = fields['Date written']
+        dt = datetime.strptime(ti, '%d-%b-%Y %H:%M')
+    except (KeyError, ValueError):
+        return None
+    ts = time.mktime(dt.timetuple())
+    return (cn, fn, ts, jl, ji, vol)
+
+
+# Bareos/Bacula block and record layout, see src/stored/block.h and record.h
+BLKHDR1_ID, BLKHDR2_ID = (b'BB01', b'BB02')
+BLKHDR1_LENGTH, BLKHDR2_LENGTH = (16, 24)
+RECHDR1_LENGTH, RECHDR2_LENGTH = (20, 12)
+VOL_LABEL, SOS_LABEL = (-2, -4)
+label_max_blocks = 4
+label_max_block_len = 4 * 1024 * 1024
+
+
+class LabelError(Exception):
+    pass
+
+
+class LabelReader(object):
+    """Unserializes a label record the way src/lib/serial.h writes it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.pos + size > len(self.data):
+            raise LabelError('label record is truncated')
+        value, = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += size
+        return value
+
+    def uint32(self):
+        return self._unpack('>I')
+
+    def int64(self):
+        return self._unpack('>q')
+
+    def float64(self):
+        return self._unpack('>d')
+
+    def string(self):
+        end = self.data.find(b'\0', self.pos)
+        if end < 0:
+            raise LabelError('label string is not terminated')
+        value = self.data[self.pos:end].decode('utf-8', 'replace')
+        self.pos = end + 1
+        return value
+
+
+def iter_volume_records(f):
+    """Yields (FileIndex, Stream, data) of the records in the leading blocks.
+
+    A record that doesn't fit into a block goes on in the next one behind a
+    header with the negated Stream and the number of bytes still to come."""
+    offset = 0
+    partial = None
+    for n in range(label_max_blocks):
+        f.seek(offset)
+        hdr = f.read(BLKHDR2_LENGTH)
+        if len(hdr) < BLKHDR1_LENGTH:
+            return
+        checksum, block_len, block_number, block_id = struct.unpack_from('>III4s', hdr)
+        if block_id == BLKHDR2_ID:
+            hdr_len, rec_len, rec_fmt = (BLKHDR2_LENGTH, RECHDR2_LENGTH, '>iiI')
+        elif block_id == BLKHDR1_ID:
+            hdr_len, rec_len, rec_fmt = (BLKHDR1_LENGTH, RECHDR1_LENGTH, '>8xiiI')
+        else:
+            raise LabelError('unknown block id %r' % block_id)
+        if block_len < hdr_len or block_len > label_max_block_len:
+            raise LabelError('bad block length %d' % block_len)
+        f.seek(offset)
+        block = f.read(block_len)
+        if len(block) < block_len:
+            raise LabelError('block %d is truncated' % block_number)
+        pos = hdr_len
+        while pos + rec_len <= block_len:
+            file_index, stream, data_len = struct.unpack_from(rec_fmt, block, pos)
+            pos += rec_len
+            if stream < 0:
+                if partial is None or partial[:2] != (file_index, -stream):
+                    raise LabelError('continuation of an unknown record in block %d' % block_number)
+                file_index, stream, data, length = partial
+                data += block[pos:pos + data_len]
+            else:
+                data, length = (block[pos:pos + data_len], data_len)
+            pos += data_len
+            if len(data) < length:
+                partial = (file_index, stream, data, length)
+                break
+            partial = None
+            yield file_index, stream, data
+        offset += block_len
+
+
+def read_volume_label(volume):
+    """Reads the first session label straight from the volume file.
+
+    Returns the same tuple as parse_vol or None when the volume doesn't start
+    with a label this reader understands (tapes, Bacula < 3.0 labels), in which
+    case the caller has to ask bls."""
+    try:
+        with open(volume, 'rb') as f:
+            seen_vol_label = False
+            for file_index, stream, data in iter_volume_records(f):
+                if file_index == VOL_LABEL:
+                    seen_vol_label = True
+                elif file_index == SOS_LABEL and seen_vol_label:
+                    return unser_session_label(data, os.path.basename(volume))
+    except (IOError, OSError, LabelError) as e:
+        debug('Native label reader failed on %s: %s' % (volume, e))
+    return None
+
+
+def unser_session_label(data, vol):
+    r = LabelReader(data)
+    if not r.string().endswith('immortal\n'):
+        raise LabelError('not a session label')
+    ver_num = r.uint32()
+    if ver_num < 11:
+        # Date is a julian day/time pair before 11, leave it to bls
+        raise LabelError('session label version %d is not supported' % ver_num)
+    ji = r.uint32()
+    write_btime = r.int64()
+    r.float64()  # write_time
+    r.string()   # PoolName
+    r.string()   # PoolType
+    r.string()   # JobName
+    cn = r.string()
+    r.string()   # Job
+    fn = r.string()
+    r.uint32()   # JobType
+    jl = chr(r.uint32())
+    # bls prints "Date written" with minute resolution, keep timestamps equal
+    dt = datetime.fromtimestamp(write_btime // 1000000).replace(second=0)
+    ts = time.mktime(dt.timetuple())
+    return (cn, fn, ts, jl, str(ji), vol)
+
+
+def parse_vol(volume, timeout=None):
+    """Parses volume and returns jobname and timestamp of job.
+
+    The label is read natively when possible, bls is the fallback."""
+    if config.native_label_reader:
+        vol_parsed = read_volume_label(volume)
+        if vol_parsed:
+            return vol_parsed
+    fields, timed_out = run_bls(volume, timeout or config.bls_timeout_max)
+    return parse_bls_output(fields, os.path.basename(volume))
+
+
+def print_vol(volume, vol_parsed):
+    vol = os.path.basename(volume)
+    if not vol_parsed:
+        print_color(bcolors.WARNING, "NEED!!! Deleting volume, because no metadata found: %s" % vol)
+        print_color(bcolors.DARKGRAY, "sudo -u bareos rm %s" % volume)
+        return
+    cn, fn, ts, jl, ji, vol = vol_parsed
+    ti = datetime.fromtimestamp(ts).strftime('%d-%b-%Y %H:%M')
+    print('{5:<6} {0:<50} {1:<5} {2:<25} {3:<18} {4:<15}'.format(vol, config.levels.get(jl, jl), cn, ti, fn, ji))
+
+
+class VolumeCache(object):
+    """Parsed volume metadata kept between runs.
+
+    Entries are keyed by volume path and are only valid while size, mtime and
+    inode of the file are unchanged, so an overwritten volume is parsed again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.changed = False
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                print_color(bcolors.WARNING, 'Ignoring broken volume cache %s' % path)
+
+    @staticmethod
+    def _stamp(st):
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def get(self, volpath, st):
+        entry = self.entries.get(volpath)
+        if entry and entry['stat'] == self._stamp(st):
+            return tuple(entry['parsed'])
+
+    def put(self, volpath, st, vol_parsed):
+        self.entries[volpath] = {'stat': self._stamp(st), 'parsed': list(vol_parsed)}
+        self.changed = True
+
+    def drop(self, volpath):
+        if self.entries.pop(volpath, None) is not None:
+            self.changed = True
+
+    def prune(self):
+        """Drops entries for volume files that no longer exist."""
+        for volpath in list(self.entries):
+            if not os.path.exists(volpath):
+                del self.entries[volpath]
+                self.changed = True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        write_atomic(self.path, json.dumps(self.entries))
+        self.changed = False
+
+
+class AdaptiveTimeout(object):
+    """bls timeout that follows observed scan durations.
+
+    The timeout is bls_timeout_factor times the 95th percentile of the time
+    recent scans needed to print the session label, clamped to
+    [bls_timeout_min, bls_timeout_max]."""
+
+    def __init__(self, lo, hi, factor, window=200):
+        self.lo, self.hi, self.factor = lo, hi, factor
+        self.durations = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def value(self):
+        with self.lock:
+            if not self.durations:
+                return self.hi
+            d = sorted(self.durations)
+        p95 = d[min(len(d) - 1, int(len(d) * 0.95))]
+        return min(self.hi, max(self.lo, p95 * self.factor))
+
+
+def scan_volumes(volpaths, cache):
+    """Parses volumes with a bounded pool of bls workers.
+
+    Volumes unchanged since the last run are answered from the cache, then the
+    label is read natively. Volumes the reader can't decode are scanned by at
+    most scan_workers bls processes in total and at most scan_workers_per_mount
+    on any one filesystem. A volume whose scan hits the
+    adaptive timeout before printing its label is retried once with
+    bls_timeout_max before it is reported as having no metadata. Volumes
+    whose file is gone by now, recycled or deleted by a parallel partition,
+    are left out.
+    Returns {volpath: vol_parsed or None}."""
+    results = dict()
+    todo = Queue()
+    stats = dict()
+    for volpath in volpaths:
+        try:
+            st = os.stat(volpath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            print_color(bcolors.WARNING, 'Skipping volume, because it vanished before it was scanned: %s' % volpath)
+            metrics.inc('volumes_skipped', reason='vanished')
+            cache.drop(volpath)
+            continue
+        vol_parsed = cache.get(volpath, st)
+        if vol_parsed:
+            metrics.inc('volumes_scanned', source='cache')
+        elif config.native_label_reader:
+            vol_parsed = read_volume_label(volpath)
+            if vol_parsed:
+                metrics.inc('volumes_scanned', source='native')
+                cache.put(volpath, st, vol_parsed)
+        if vol_parsed:
+            results[volpath] = vol_parsed
+            continue
+        stats[volpath] = st
+        todo.put(volpath)
+    if todo.empty():
+        return results
+
+    mount_locks = dict()
+    for volpath in stats:
+        mount = find_mount_point(os.path.dirname(volpath))
+        if mount not in mount_locks:
+            mount_locks[mount] = threading.BoundedSemaphore(config.scan_workers_per_mount)
+        mount_locks[volpath] = mount_locks[mount]
+    timeout = AdaptiveTimeout(config.bls_timeout_min, config.bls_timeout_max, config.bls_timeout_factor)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                volpath = todo.get_nowait()
+            except Empty:
+                return
+            with mount_locks[volpath]:
+                t = timeout.value()
+                started = time.time()
+                fields, timed_out = run_bls(volpath, t)
+                if timed_out and t < config.bls_timeout_max:
+                    debug('bls timed out after %.2fs, retrying %s' % (t, volpath))
+                    started = time.time()
+                    fields, timed_out = run_bls(volpath, config.bls_timeout_max)
+                if not timed_out:
+                    timeout.record(time.time() - started)
+            vol_parsed = parse_bls_output(fields, os.path.basename(volpath))
+            metrics.inc('volumes_scanned', source='bls' if vol_parsed else 'no-metadata')
+            with lock:
+                results[volpath] = vol_parsed
+                if vol_parsed:
+                    cache.put(volpath, stats[volpath], vol_parsed)
+
+    workers = [threading.Thread(target=worker) for i in range(min(config.scan_workers, len(stats)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""What-if replay of retention policies over the job history."""
+
+import json
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime
+from fnmatch import fnmatchcase
+
+from .util import format_size, to_str, write_atomic
+
+
+class RetentionPolicy(object):
+    """Retention rules of a simulation, see README.md.
+
+    Keys at the top level are the defaults, the first entry of overrides whose
+    client and fileset patterns match a chain replaces them for that chain."""
+
+    defaults = {'min_fulls': 4, 'min_diffs': 0, 'protect_chains': True}
+
+    def __init__(self, policy):
+        self.base = dict(self.defaults)
+        self.base.update((k, v) for k, v in policy.items() if k != 'overrides')
+        self.overrides = policy.get('overrides', [])
+        for rules in [self.base] + self.overrides:
+            unknown = set(rules) - set(self.defaults) - set(['retention', 'client', 'fileset'])
+            if unknown:
+                raise ValueError('unknown policy keys %s' % ', '.join(sorted(unknown)))
+        if sorted(self.base.get('retention', {})) != ['D', 'F', 'I']:
+            raise ValueError('retention needs days for the levels F, D and I')
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def rules(self, client, fileset):
+        rules = dict(self.base)
+        rules['retention'] = dict(self.base['retention'])
+        for override in self.overrides:
+            if fnmatchcase(client, override.get('client', '*')) and fnmatchcase(fileset, override.get('fileset', '*')):
+                for k, v in override.items():
+                    if k == 'retention':
+                        rules['retention'].update(v)
+                    elif k not in ('client', 'fileset'):
+                        rules[k] = v
+                break
+        return rules
+
+
+def simulate_chain(chain, rules, start, days):
+    """Replays the decisions on one backup chain under a retention policy.
+
+    A job counts as purged retention days after its jobtdate. On any day the
+    jobs of a level that exist and aren't purged are a slice [lo, hi) of the
+    sorted level array, both ends only move forward, so every rule of
+    decide_full, decide_incr and decide_diff is a bisect inside the slice.
+    The chain is only evaluated at the end of day 0 and of days on which one
+    of its jobs is written or purged.
+    Yields (day, deleted rows, purged volumes kept) for those days."""
+    levels = ('F', 'D', 'I')
+    T = [chain.times[L] for L in levels]
+    F, D, I = 0, 1, 2
+
+    def day_of(t):
+        return max(0, int(-(-(t - start) // 86400)))
+
+    arrive = [[day_of(t) for t in T[L]] for L in (F, D, I)]
+    purge = [[day_of(t + rules['retention'][levels[L]] * 86400) for t in T[L]] for L in (F, D, I)]
+    event_days = set([0])
+    for L in (F, D, I):
+        event_days.update(arrive[L])
+        event_days.update(purge[L])
+    lo = [0, 0, 0]
+    hi = [0, 0, 0]
+    pending = [[], [], []]
+    protect = rules['protect_chains']
+    min_fulls = rules['min_fulls']
+    min_diffs = rules['min_diffs']
+    tF, tD, tI = T
+    for day in sorted(x for x in event_days if x <= days):
+        for L in (F, D, I):
+            n = len(T[L])
+            while hi[L] < n and arrive[L][hi[L]] <= day:
+                hi[L] += 1
+            while lo[L] < n and purge[L][lo[L]] <= day:
+                pending[L].append(lo[L])
+                lo[L] += 1
+        if not (pending[F] or pending[D] or pending[I]):
+            yield day, [], 0
+            continue
+        loF, loD, loI = lo
+        hiF, hiD, hiI = hi
+        deleted = [[], [], []]
+        if pending[F]:
+            pending_times = [tF[i] for i in pending[F]]
+            active_fulls = hiF - loF
+            for n, i in enumerate(pending[F]):
+                t = tF[i]
+                newer_purged = len(pending_times) - bisect_right(pending_times, t, n)
+                if active_fulls < 1 or newer_purged + active_fulls < min_fulls:
+                    # the newest full, no full left or too few fulls
+                    continue
+                if protect:
+                    f = bisect_right(tF, t, loF, hiF)
+                    next_full = tF[f] if f < hiF else None
+                    d = bisect_right(tD, t, loD, hiD)
+                    next_diff = tD[d] if d < hiD else None
+                    next_fd = min(next_full or float('inf'), next_diff or float('inf'))
+                    a = bisect_right(tI, t, loI, hiI)
+                    if a < bisect_left(tI, next_fd, a, hiI):
+                        continue
+                    if next_full is None:
+                        if d < hiD:
+                            continue
+                    elif d < bisect_left(tD, next_full, d, hiD):
+                        continue
+                deleted[F].append(i)
+        if pending[I]:
+            for i in pending[I]:
+                t = tI[i]
+                if protect:
+                    f = bisect_left(tF, t, loF, hiF)
+                    d = bisect_left(tD, t, loD, hiD)
+                    prev_fd = max(tF[f - 1] if f > loF else -1, tD[d - 1] if d > loD else -1)
+                    f = bisect_right(tF, t, f, hiF)
+                    d = bisect_right(tD, t, d, hiD)
+                    next_fd = min(tF[f] if f < hiF else float('inf'), tD[d] if d < hiD else float('inf'))
+                    a = bisect_right(tI, prev_fd, loI, hiI)
+                    if a < bisect_left(tI, next_fd, a, hiI):
+                        continue
+                deleted[I].append(i)
+        if pending[D]:
+            for i in pending[D]:
+                t = tD[i]
+                f = bisect_right(tF, t, loF, hiF)
+                d = bisect_right(tD, t, loD, hiD)
+                if f == hiF and d == hiD:
+                    # the latest diff
+                    continue
+                if protect:
+                    next_fd = min(tF[f] if f < hiF else float('inf'), tD[d] if d < hiD else float('inf'))
+                    a = bisect_right(tI, t, loI, hiI)
+                    if a < bisect_left(tI, next_fd, a, hiI):
+                        continue
+                if hiD - loD < min_diffs:
+                    continue
+                deleted[D].append(i)
+        rows = list()
+        for L in (F, D, I):
+            if deleted[L]:
+                gone = set(deleted[L])
+                pending[L] = [i for i in pending[L] if i not in gone]
+                level_rows = chain.rows[levels[L]]
+                rows.extend(level_rows[i] for i in deleted[L])
+        yield day, rows, len(pending[F]) + len(pending[D]) + len(pending[I])
+
+
+def simulate_retention(chains, catalog, policy, days, end, report_file=None):
+    """Replays the last days of job history under policy, for all chains.
+
+    Prints per day the volumes and bytes that would have been freed and the
+    restore points (jobs) lost with them, report_file gets the lost restore
+    points as JSON."""
+    started = time.time()
+    start = end - days * 86400
+    volbytes = dict((to_str(volname), int(size or 0)) for volname, storage, status, size, pool in catalog.iter_media())
+    volume_jobs = dict()
+    for chain in chains.chains.values():
+        for L in ('F', 'D', 'I'):
+            for row in chain.rows[L]:
+                volume_jobs[row.volumename] = volume_jobs.get(row.volumename, 0) + 1
+    freed_volumes = [0] * (days + 1)
+    freed_bytes = [0] * (days + 1)
+    lost = [list() for day in range(days + 1)]
+    kept_delta = [0] * (days + 1)
+    for (client, fileset), chain in chains.chains.items():
+        rules = policy.rules(client, fileset)
+        kept = 0
+        for day, rows, now_kept in simulate_chain(chain, rules, start, days):
+            kept_delta[day] += now_kept - kept
+            kept = now_kept
+            for row in rows:
+                lost[day].append(row)
+                volume_jobs[row.volumename] -= 1
+                if volume_jobs[row.volumename] == 0:
+                    freed_volumes[day] += 1
+                    freed_bytes[day] += volbytes.get(row.volumename, 0)
+    print("Simulated %d days of %d backup chains in %.2fs\n" % (days, len(chains.chains), time.time() - started))
+    print('{0:<12} {1:>8} {2:>10} {3:>15} {4:>12}'.format('Day', 'Volumes', 'Freed', 'Restore points', 'Purged kept'))
+    print("-----------------------------------------------------------------")
+    kept = 0
+    report = list()
+    for day in range(days + 1):
+        kept += kept_delta[day]
+        date = datetime.fromtimestamp(start + day * 86400).strftime('%Y-%m-%d')
+        print('{0:<12} {1:>8} {2:>10} {3:>15} {4:>12}'.format(
+              date if day else 'backlog', freed_volumes[day], format_size(freed_bytes[day]), len(lost[day]), kept))
+        if not report_file:
+            continue
+        report.append(OrderedDict([('date', date), ('volumes', freed_volumes[day]), ('bytes', freed_bytes[day]),
+                                   ('purged_kept', kept),
+                                   ('lost', [OrderedDict([('client', x.clientname), ('fileset', x.fileset), ('level', x.level),
+                                                          ('jobtdate', x.jobtdate), ('volume', x.volumename)]) for x in lost[day]])]))
+    print('{0:<12} {1:>8} {2:>10} {3:>15}'.format('total', sum(freed_volumes), format_size(sum(freed_bytes)),
+                                                  sum(len(x) for x in lost)))
+    if report_file:
+        write_atomic(report_file, json.dumps(report) + '\n')
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Local copies of the catalog data the planner reads."""
+
+import json
+import os
+import sys
+import time
+from array import array
+from datetime import date
+from decimal import Decimal
+from sys import intern
+
+from .catalog import Catalog, CatalogJob
+from .util import to_str
+
+
+SNAPSHOT_FORMAT = 'delete_purged_volumes_bareos snapshot'
+SNAPSHOT_VERSION = 3
+
+
+def write_snapshot(catalog, path):
+    """Exports what the planner reads from the catalog into a local file.
+
+    The file starts with two lines of JSON: a small header (format, creation
+    time and the identity of the catalog) so the age can be checked without
+    loading the data, then the tables with names kept once in string tables.
+    The numeric columns follow as the raw bytes of their arrays."""
+    started = time.time()
+    # One read transaction, volumes labeled meanwhile would miss behind the jobs on them
+    catalog.begin_transaction()
+    try:
+        data = read_catalog(catalog)
+    finally:
+        catalog.end_transaction()
+    header = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, 'created': time.time(),
+              'catalog': catalog.identity}
+    tables = dict(data, columns=list(), byteorder=sys.byteorder)
+    for table in ('media', 'jobs'):
+        tables[table] = dict(data[table])
+        for column, values in sorted(data[table].items()):
+            if isinstance(values, array):
+                tables['columns'].append([table, column, values.typecode, values.itemsize, len(values)])
+                del tables[table][column]
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write((json.dumps(header) + '\n').encode('utf-8'))
+        f.write((json.dumps(tables, default=json_value) + '\n').encode('utf-8'))
+        for table, column, typecode, itemsize, length in tables['columns']:
+            data[table][column].tofile(f)
+    os.rename(tmp, path)
+    print("Snapshot of %d volumes and %d jobs written to %s in %.2fs" % (
+          len(data['volumes']), len(data['jobs']['level']), path, time.time() - started))
+
+
+def read_catalog(catalog):
+    """The tables of a snapshot, column by column."""
+    volumes, volume_ids = (list(), dict())
+    storages, statuses, pools = (StringTable(), StringTable(), StringTable())
+    media = {'storage': array('l'), 'volstatus': array('l'), 'volbytes': array('q'), 'pool': array('l')}
+    for volumename, storagename, volstatus, volbytes, poolname in catalog.iter_media():
+        volumename = to_str(volumename)
+        volume_ids[volumename] = len(volumes)
+        volumes.append(volumename)
+        media['storage'].append(storages.id(to_str(storagename)))
+        media['volstatus'].append(statuses.id(to_str(volstatus)))
+        media['volbytes'].append(int(volbytes or 0))
+        media['pool'].append(pools.id(to_str(poolname)))
+    clients, filesets = (StringTable(), StringTable())
+    jobs = {'volume': array('l'), 'jobtdate': array('q'), 'level': list(), 'client': array('l'), 'fileset': array('l')}
+    for job in catalog.iter_jobs():
+        volume_id = volume_ids.get(job.volumename)
+        # Only without a consistent snapshot: a volume labeled after iter_media
+        if volume_id is None:
+            continue
+        jobs['volume'].append(volume_id)
+        jobs['jobtdate'].append(job.jobtdate)
+        jobs['level'].append(job.level)
+        jobs['client'].append(clients.id(job.clientname))
+        jobs['fileset'].append(filesets.id(job.fileset))
+    jobs['level'] = ''.join(jobs['level'])
+    return {
+        'volumes': volumes, 'storages': storages.strings, 'statuses': statuses.strings, 'pools': pools.strings,
+        'media': media,
+        'clients': clients.strings, 'filesets': filesets.strings, 'jobs': jobs,
+        'purged_with_jobs': sorted(volume_ids[x] for x in catalog.purged_volnames_with_jobs() if x in volume_ids),
+        'failed': catalog.failed_volumes(), 'recycles': catalog.recycle_volumes(),
+    }
+
+
+class StringTable(object):
+    def __init__(self):
+        self.strings = list()
+        self.ids = dict()
+
+    def id(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+def json_value(value):
+    """Dates and MySQL decimals of the failed and recycle volumes."""
+    if isinstance(value, Decimal):
+        return int(value)
+    if isinstance(value, date):
+        return str(value)
+    raise TypeError('%r can not be stored in a snapshot' % (value,))
+
+
+def read_snapshot_header(f):
+    try:
+        header = json.loads(f.readline(65536).decode('utf-8'))
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError('not a snapshot file')
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('snapshot version %s is not supported' % header.get('version'))
+    return header
+
+
+def read_snapshot_data(f):
+    """The tables following the header, with the columns back in arrays."""
+    data = json.loads(f.readline().decode('utf-8'))
+    for table, column, typecode, itemsize, length in data.pop('columns'):
+        values = array(typecode)
+        if values.itemsize != itemsize:
+            raise ValueError('snapshot column %s.%s has %d byte items, here they have %d' % (
+                             table, column, itemsize, values.itemsize))
+        try:
+            values.fromfile(f, length)
+        except EOFError:
+            raise ValueError('snapshot is truncated')
+        if data['byteorder'] != sys.byteorder:
+            values.byteswap()
+        data[table][column] = values
+    return data
+
+
+class SnapshotCatalog(Catalog):
+    """Catalog read from a file written by write_snapshot."""
+    name = 'snapshot'
+
+    def __init__(self, path):
+        Catalog.__init__(self)
+        self.path = path
+
+    def connect(self):
+        with open(self.path, 'rb') as f:
+            # The format and version are checked before any data is read
+            self.header = read_snapshot_header(f)
+            self.data = read_snapshot_data(f)
+        self.created = self.header['created']
+        self.identity = dict(self.header['catalog'], snapshot=self.path)
+
+    def close(self):
+        pass
+
+    def age(self):
+        return time.time() - self.created
+
+    def iter_jobs(self, clients=None):
+        d = self.data
+        jobs, volumes, names, filesets = (d['jobs'], d['volumes'], d['clients'], d['filesets'])
+        volumes = [intern(x) for x in volumes]
+        selected = set(clients) if clients else None
+        clients = [intern(x) for x in names]
+        filesets = [intern(x) for x in filesets]
+        levels = [intern(x) for x in jobs['level']]
+        for i in range(len(levels)):
+            if selected is not None and clients[jobs['client'][i]] not in selected:
+                continue
+            yield CatalogJob(volumes[jobs['volume'][i]], jobs['jobtdate'][i], levels[i],
+                             clients[jobs['client'][i]], filesets[jobs['fileset'][i]])
+
+    def iter_media(self):
+        d = self.data
+        media = d['media']
+        for i, volumename in enumerate(d['volumes']):
+            yield (volumename, d['storages'][media['storage'][i]], d['statuses'][media['volstatus'][i]],
+                   media['volbytes'][i], d['pools'][media['pool'][i]])
+
+    def purged_volnames_with_jobs(self):
+        return set(self.data['volumes'][i] for i in self.data['purged_with_jobs'])
+
+    def purged_volumes(self, pools=None, storages=None):
+        return [{'volname': volname, 'storagename': storagename, 'poolname': poolname}
+                for volname, storagename, volstatus, volbytes, poolname in self.iter_media()
+                if volstatus == 'Purged' and storagename is not None
+                and (not pools or poolname in pools) and (not storages or storagename in storages)]
+
+    def media_volnames(self):
+        return set(self.data['volumes'])
+
+    def failed_volumes(self):
+        return self.data['failed']
+
+    def recycle_volumes(self):
+        return self.data['recycles']
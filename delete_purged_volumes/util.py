@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Output and small helpers shared by all modules."""
+
+import os
+import resource
+import sys
+import traceback
+
+from . import config
+
+# Set by the command when the terminal shows colors
+ISCOLOR = False
+
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+    DARKGRAY = '\033[90m'
+
+def print_color(color, text):
+    if text is None:
+        return
+    if ISCOLOR:
+        print(color + text + bcolors.ENDC)
+    else:
+        print(text)
+
+
+def find_mount_point(path):
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def format_exception(e):
+    """Usage: except Exception as e:
+                  log.error(format_exception(e)) """
+    exception_list = traceback.format_stack()
+    exception_list = exception_list[:-2]
+    exception_list.extend(traceback.format_tb(sys.exc_info()[2]))
+    exception_list.extend(traceback.format_exception_only(sys.exc_info()[0], sys.exc_info()[1]))
+    exception_str = 'Traceback (most recent call last):\n'
+    exception_str += ''.join(exception_list)
+    exception_str = exception_str[:-1]  # Removing the last \n
+    return exception_str
+
+
+def vols2str(vols):
+    s = ''
+    #print('[%d] %s' % (len(vols), type(vols)))
+    if not isinstance(vols, (list, tuple)):
+        vols = [vols]
+
+    if len(vols) == 0:
+        s = '\t( EMPTY )\n'
+    else:
+        for vol in vols:
+            s = s + '\t{0:<50} {1:<11}\n'.format(vol['volumename'], vol['jobtdate'])
+    return s
+
+
+def debug(message):
+    if config.is_debug:
+        print(message)
+
+
+def to_str(value):
+    """Names are BLOB columns in the MySQL catalog and come back as bytes."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return rss / 1048576.0
+    return rss / 1024.0
+
+
+def format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fT' % size
+
+
+def write_atomic(path, text):
+    """Replaces path by a file holding text, after a crash it holds the old or the new text."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
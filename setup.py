@@ -0,0 +1,16 @@
+from setuptools import setup
+
+setup(
+    name='delete_purged_volumes',
+    version='1.0',
+    description='Deletes purged volumes from Bareos/Bacula catalog and disk',
+    packages=['delete_purged_volumes'],
+    python_requires='>=3.6',
+    entry_points={
+        'console_scripts': ['delete_purged_volumes_bareos = delete_purged_volumes.cli:main'],
+    },
+    extras_require={
+        'mysql': ['mysqlclient'],
+        'postgresql': ['psycopg2'],
+    },
+)
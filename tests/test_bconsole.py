@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""The bconsole session against a bconsole that hangs after running a command."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from delete_purged_volumes import config
+from delete_purged_volumes.bconsole import BconsoleSession
+from delete_purged_volumes.metrics import metrics
+
+# Deletes volumes once, later deletes of them find nothing. On the first
+# connection it hangs after deleting the volume "hang", before the marker.
+STUB_BCONSOLE = '''
+import os, sys, time
+state = sys.argv[1]
+connections = os.path.join(state, 'connections')
+n = int(open(connections).read()) + 1 if os.path.exists(connections) else 1
+open(connections, 'w').write(str(n))
+deleted_file = os.path.join(state, 'deleted')
+print('Connecting to Director', flush=True)
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+    if line.startswith('@echo '):
+        print(line[6:], flush=True)
+    elif line.startswith('delete volume='):
+        vol = line.split('=', 1)[1].split()[0]
+        deleted = open(deleted_file).read().split() if os.path.exists(deleted_file) else []
+        if vol in deleted or vol.startswith('missing'):
+            print('Media record for Volume "%s" not found.' % vol, flush=True)
+            continue
+        with open(deleted_file, 'a') as f:
+            f.write(vol + '\\n')
+        print('Volume "%s" deleted.' % vol, flush=True)
+        if vol == 'hang' and n == 1:
+            time.sleep(60)
+    elif line == 'quit':
+        break
+'''
+
+
+class BconsoleSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        stub = os.path.join(self.tmp, 'bconsole.py')
+        with open(stub, 'w') as f:
+            f.write(STUB_BCONSOLE)
+        self.session = BconsoleSession([sys.executable, stub, self.tmp], batch_size=10, timeout=1)
+        metrics.reset()
+        patcher = mock.patch.object(config, 'lock_dir', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmp)
+
+    def run_deletes(self, volnames):
+        for volname in volnames:
+            self.session.queue(volname, 'delete volume=%s yes' % volname)
+        return dict((volname, ok) for volname, command, ok, out in self.session.flush())
+
+    def test_hung_bconsole_is_replaced(self):
+        started = time.time()
+        results = self.run_deletes(['a', 'hang', 'b'])
+        self.assertLess(time.time() - started, 30)
+        # "hang" was deleted before bconsole hung, sent again it isn't found
+        self.assertEqual(results, {'a': True, 'hang': True, 'b': True})
+        self.assertEqual(self.session.failed, [])
+        self.assertEqual(metrics.counters[('bconsole_timeouts', ())], 1)
+        with open(os.path.join(self.tmp, 'connections')) as f:
+            self.assertEqual(f.read(), '2')
+
+    def test_missing_volume_fails_on_first_attempt(self):
+        results = self.run_deletes(['a', 'missing-1'])
+        self.assertEqual(results, {'a': True, 'missing-1': False})
+        self.assertEqual([volname for volname, command, out in self.session.failed], ['missing-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Reading Bareos configs: includes, the directory layout, quoting and the config cache."""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from delete_purged_volumes.conf import ConfigCache, conf_get, index_resources, parse_conf, read_conf
+
+
+class ConfFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def names(self, resources, thing):
+        return sorted(index_resources(resources, thing))
+
+
+class ConfTest(ConfFiles):
+
+    def test_include(self):
+        path = self.write('bareos-sd.conf', 'Storage {\n  Name = sd\n}\n@devices/disk.conf\n@"devices/tape*.conf"\n')
+        self.write('devices/disk.conf', 'Device {\n  Name = disk\n  Archive Device = /srv/disk\n}\n@../more.conf\n')
+        self.write('devices/tape1.conf', 'Device { Name = tape1; Archive Device = /dev/nst0 }\n')
+        self.write('devices/tape2.conf', 'Device { Name = tape2; Archive Device = /dev/nst1 }\n')
+        self.write('more.conf', 'Autochanger {\n  Name = changer\n  Device = tape1, tape2\n}\n')
+        resources = read_conf(path)
+        self.assertEqual(self.names(resources, 'Device'), ['disk', 'tape1', 'tape2'])
+        self.assertEqual(self.names(resources, 'Autochanger'), ['changer'])
+        devices = index_resources(resources, 'Device')
+        self.assertEqual(conf_get(devices['tape2'], 'ArchiveDevice'), '/dev/nst1')
+
+    def test_include_loop(self):
+        path = self.write('bareos-dir.conf', '@bareos-dir.conf\n')
+        with self.assertRaises(ValueError):
+            read_conf(path)
+
+    def test_directory_layout(self):
+        self.write('bareos-dir.d/director/bareos-dir.conf', 'Director {\n  Name = dir\n  DirPort = 9101\n}\n')
+        self.write('bareos-dir.d/catalog/MyCatalog.conf', 'Catalog {\n  Name = MyCatalog\n  dbdriver = sqlite3\n}\n')
+        self.write('bareos-dir.d/storage/File.conf', 'Storage {\n  Name = File\n  Device = FileStorage\n}\n')
+        self.write('bareos-dir.d/storage/README', 'Storage { Name = ignored }\n')
+        # The directory is used when the config file doesn't exist
+        for path in (os.path.join(self.tmp, 'bareos-dir.d'), os.path.join(self.tmp, 'bareos-dir.conf')):
+            resources = read_conf(path)
+            self.assertEqual(self.names(resources, 'Director'), ['dir'])
+            self.assertEqual(self.names(resources, 'Catalog'), ['MyCatalog'])
+            self.assertEqual(self.names(resources, 'Storage'), ['File'])
+
+    def test_quoted_braces(self):
+        resources = parse_conf([
+            'Catalog {\n',
+            '  Name = MyCatalog  # the only one\n',
+            '  DB Password = "p{a}ss;w#rd"\n',
+            '  DB Name = "bareos"; DB User = bareos\n',
+            '}\n',
+            'Director { Name = "dir {1}"; Description = "a } b" }\n',
+        ])
+        catalog = index_resources(resources, 'Catalog')['MyCatalog']
+        self.assertEqual(conf_get(catalog, 'dbpassword'), 'p{a}ss;w#rd')
+        self.assertEqual(conf_get(catalog, 'DbName'), 'bareos')
+        self.assertEqual(conf_get(catalog, 'dbuser'), 'bareos')
+        director = index_resources(resources, 'Director')['dir {1}']
+        self.assertEqual(conf_get(director, 'description'), 'a } b')
+        self.assertIsNone(conf_get(director, 'DirPort'))
+        self.assertEqual(conf_get(None, 'DirPort', 9101), 9101)
+
+
+class ConfigCacheTest(ConfFiles):
+
+    def setUp(self):
+        ConfFiles.setUp(self)
+        self.conf = self.write('bareos-sd.conf', 'Device {\n  Name = disk\n}\n@devices/*.conf\n')
+        self.write('devices/tape.conf', 'Device {\n  Name = tape\n}\n')
+        self.cache_path = os.path.join(self.tmp, 'conf.cache')
+
+    def read(self):
+        """Reads the config through a cache loaded from disk, returns (device names, from cache)."""
+        cache = ConfigCache(self.cache_path)
+        cached = cache.get(self.conf) is not None
+        resources = read_conf(self.conf, cache)
+        cache.save()
+        return self.names(resources, 'Device'), cached
+
+    def test_owner_only(self):
+        # A tmp file left by a crashed run, readable by everyone
+        self.write('conf.cache.tmp', '{}')
+        os.chmod(self.cache_path + '.tmp', 0o644)
+        self.read()
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_path).st_mode), 0o600)
+        self.assertFalse(os.path.exists(self.cache_path + '.tmp'))
+
+    def test_reused_while_unchanged(self):
+        self.assertEqual(self.read(), (['disk', 'tape'], False))
+        self.assertEqual(self.read(), (['disk', 'tape'], True))
+
+    def test_included_file_changed(self):
+        self.read()
+        self.write('devices/tape.conf', 'Device {\n  Name = tape2\n}\n')
+        self.assertEqual(self.read(), (['disk', 'tape2'], False))
+        self.assertEqual(self.read(), (['disk', 'tape2'], True))
+
+    def test_file_added_to_include_pattern(self):
+        self.read()
+        self.write('devices/changer.conf', 'Device {\n  Name = changer\n}\n')
+        # The new file changed the directory the pattern matched in
+        os.utime(os.path.join(self.tmp, 'devices'), (1, 1))
+        self.assertEqual(self.read(), (['changer', 'disk', 'tape'], False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""The daemon's polls against a catalog that changes between them."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from delete_purged_volumes import config, daemon
+from delete_purged_volumes.catalog import SQLiteCatalog
+from delete_purged_volumes.conf import Resource
+from delete_purged_volumes.daemon import WatchDaemon
+
+from .test_planner import DAY, START, session_label
+from .test_scan import VOL_LABEL, bb02_block, bb02_record
+
+
+class FakeConfig(object):
+
+    def __init__(self, archive):
+        self.director = Resource()
+        self.storage_dirs = {'File': [(archive, True)]}
+
+
+class WatchDaemonTest(unittest.TestCase):
+    """Client c has a full on day 0 with an incremental on day 1 depending on
+    it, and fulls on days 7 to 35."""
+
+    jobs = [(1, 'F', 0), (2, 'I', 1), (3, 'F', 7), (4, 'F', 14), (5, 'F', 21), (6, 'F', 28), (7, 'F', 35)]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp, 'archive')
+        os.mkdir(self.archive)
+        self.catalog = SQLiteCatalog(':memory:')
+        self.catalog.connect()
+        self.catalog.create_schema()
+        con = self.catalog.con
+        con.execute("INSERT INTO Storage VALUES (1, 'File')")
+        con.execute("INSERT INTO Pool VALUES (1, 'Full')")
+        con.execute("INSERT INTO FileSet VALUES (1, 'fs')")
+        con.execute("INSERT INTO Client VALUES (1, 'c')")
+        con.execute("INSERT INTO Client VALUES (2, 'w')")
+        for jobid, level, day in self.jobs:
+            self.add_job(jobid, 1, level, day)
+        con.commit()
+
+        self.daemon = WatchDaemon()
+        self.daemon.catalog = self.catalog
+        self.deleted = list()
+        for patcher in (mock.patch.object(config, 'dry_run', False),
+                        mock.patch.object(config, 'lock_dir', None),
+                        mock.patch.object(config, 'volume_cache_file', None),
+                        mock.patch.object(daemon, 'load_config', return_value=FakeConfig(self.archive)),
+                        mock.patch.object(daemon, 'director_running', return_value=True),
+                        mock.patch.object(daemon, 'del_backups', self.del_backups)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp)
+
+    def del_backups(self, remove_backup, storages):
+        self.deleted.append(sorted(os.path.basename(volpath) for volpath in remove_backup))
+
+    def add_job(self, jobid, clientid, level, day, jobstatus='T'):
+        client = 'c' if clientid == 1 else 'w'
+        volname = '%s-%02d' % (client, day)
+        jobtdate = START + day * DAY
+        self.catalog.con.execute('INSERT INTO Job (JobId, Level, ClientId, JobTDate, FileSetId, JobStatus) '
+                                 'VALUES (?, ?, ?, ?, 1, ?)', (jobid, level, clientid, jobtdate, jobstatus))
+        self.catalog.con.execute("INSERT INTO Media (MediaId, VolumeName, PoolId, StorageId, VolStatus) "
+                                 "VALUES (?, ?, 1, 1, 'Used')", (jobid, volname))
+        self.catalog.con.execute('INSERT INTO JobMedia (JobId, MediaId) VALUES (?, ?)', (jobid, jobid))
+        with open(os.path.join(self.archive, volname), 'wb') as f:
+            f.write(bb02_block(1, bb02_record(-2, 0, VOL_LABEL) +
+                               bb02_record(-4, jobid, session_label(jobid, client, 'fs', level, jobtdate))))
+
+    def execute(self, *statements):
+        for statement in statements:
+            self.catalog.con.execute(statement)
+        self.catalog.con.commit()
+
+    def purge(self, volname, keep_jobs=False):
+        self.execute("UPDATE Media SET VolStatus='Purged' WHERE VolumeName='%s'" % volname)
+        if not keep_jobs:
+            self.execute("DELETE FROM JobMedia WHERE MediaId IN (SELECT MediaId FROM Media WHERE VolumeName='%s')"
+                         % volname)
+
+    def poll(self):
+        self.deleted = list()
+        self.daemon.poll()
+        return self.deleted
+
+    def test_newly_purged_volume(self):
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.poll(), [])
+        self.purge('c-07')
+        self.assertEqual(self.poll(), [['c-07']])
+        self.assertEqual(self.poll(), [])
+
+    def test_pruned_job(self):
+        self.purge('c-00', keep_jobs=True)
+        # The incremental of day 1 depends on the full of day 0
+        self.assertEqual(self.poll(), [])
+        # Pruning it changes nothing in Media, only the job count of c
+        self.execute('DELETE FROM JobMedia WHERE JobId=2', 'DELETE FROM Job WHERE JobId=2')
+        self.assertEqual(self.poll(), [['c-00']])
+
+    def test_postponed_on_busy_storage(self):
+        self.add_job(8, 2, 'F', 40, jobstatus='R')
+        self.catalog.con.commit()
+        self.assertEqual(self.poll(), [])
+        self.purge('c-07')
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.daemon.status['volumes_postponed'], 1)
+        self.assertEqual(self.daemon.status['busy_storages'], ['File'])
+        # Still running, nothing changed in the catalog
+        self.assertEqual(self.poll(), [])
+        self.execute("UPDATE Job SET JobStatus='T' WHERE JobId=8")
+        self.assertEqual(self.poll(), [['c-07']])
+        self.assertIsNone(self.daemon.pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""The I/O budget of a process that starts out in dry runs."""
+
+import unittest
+from unittest import mock
+
+from delete_purged_volumes import config, deleter
+
+
+class IoBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.popen = mock.MagicMock()
+        self.popen.return_value.communicate.return_value = (b'', None)
+        self.popen.return_value.returncode = 0
+        for patcher in (mock.patch.object(config, 'delete_ionice', ['-c', '3']),
+                        mock.patch.object(config, 'delete_rate_limit', None),
+                        mock.patch.object(deleter, 'io_budget', None),
+                        mock.patch.object(deleter, 'ionice_applied', False),
+                        mock.patch.object(deleter, 'Popen', self.popen)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def budget(self, dry_run):
+        with mock.patch.object(config, 'dry_run', dry_run):
+            return deleter.get_io_budget()
+
+    def test_ionice_on_first_real_deletion(self):
+        budget = self.budget(True)
+        self.assertFalse(self.popen.called)
+        self.assertIs(self.budget(False), budget)
+        self.assertEqual(self.popen.call_count, 1)
+        self.assertEqual(self.popen.call_args[0][0][:3], ['ionice', '-c', '3'])
+        self.budget(False)
+        self.assertEqual(self.popen.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
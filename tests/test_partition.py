@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Which partitions may run side by side, and the locks that keep the others apart."""
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from delete_purged_volumes import config
+from delete_purged_volumes.partition import Partition, lock_path, lock_run, running_partition
+
+
+class OverlapTest(unittest.TestCase):
+
+    def assertOverlap(self, a, b, expected):
+        self.assertEqual(a.overlaps(b), expected, '%s / %s' % (a.describe(), b.describe()))
+        self.assertEqual(b.overlaps(a), expected, '%s / %s' % (b.describe(), a.describe()))
+
+    def test_disjoint(self):
+        for a, b in ((Partition(clients=['a']), Partition(clients=['b'])),
+                     (Partition(pools=['Full']), Partition(pools=['Incr'])),
+                     (Partition(storages=['File1']), Partition(storages=['File2'])),
+                     (Partition(shard=(1, 4)), Partition(shard=(2, 4))),
+                     (Partition(clients=['a'], shard=(1, 2)), Partition(clients=['a'], shard=(2, 2))),
+                     (Partition(clients=['a'], pools=['Full']), Partition(clients=['b'], pools=['Full']))):
+            self.assertOverlap(a, b, False)
+
+    def test_overlapping(self):
+        for a, b in ((Partition(), Partition(clients=['a'])),
+                     (Partition(clients=['a', 'b']), Partition(clients=['b', 'c'])),
+                     (Partition(pools=['Full']), Partition(storages=['File'])),
+                     (Partition(clients=['a']), Partition(pools=['Full'])),
+                     (Partition(shard=(1, 2)), Partition(shard=(1, 4))),
+                     (Partition(shard=(1, 2)), Partition(shard=(2, 4))),
+                     (Partition(shard=(3, 4)), Partition(shard=(3, 4))),
+                     (Partition(shard=(1, 4)), Partition(clients=['a']))):
+            self.assertOverlap(a, b, True)
+
+
+class LockRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        patcher = mock.patch.object(config, 'lock_dir', self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.locks = list()
+
+    def tearDown(self):
+        for locks in self.locks:
+            for lock in locks:
+                lock.close()
+        shutil.rmtree(self.tmp)
+
+    def lock(self, partition):
+        locks = lock_run(partition)
+        if locks is not None:
+            self.locks.append(locks)
+        return locks
+
+    def release(self, locks):
+        self.locks.remove(locks)
+        for lock in locks:
+            lock.close()
+
+    def test_second_run_is_refused(self):
+        first = self.lock(Partition())
+        self.assertIsNotNone(first)
+        self.assertIsNone(self.lock(Partition()))
+        self.assertIsNone(self.lock(Partition(shard=(1, 4))))
+        self.release(first)
+        self.assertIsNotNone(self.lock(Partition()))
+
+    def test_partition_blocks_catalog_wide_run(self):
+        self.assertIsNotNone(self.lock(Partition(pools=['Full'])))
+        self.assertIsNone(self.lock(Partition()))
+
+    def test_disjoint_partitions_run_side_by_side(self):
+        self.assertIsNotNone(self.lock(Partition(shard=(1, 4))))
+        self.assertIsNotNone(self.lock(Partition(shard=(2, 4))))
+        self.assertIsNotNone(self.lock(Partition(clients=['a'], shard=(3, 4))))
+        self.assertIsNone(self.lock(Partition(shard=(1, 2))))
+        self.assertIsNone(self.lock(Partition(shard=(2, 4))))
+
+    def test_overlapping_selectors_are_refused(self):
+        self.assertIsNotNone(self.lock(Partition(pools=['Full'])))
+        self.assertIsNone(self.lock(Partition(storages=['File'])))
+        self.assertIsNone(self.lock(Partition(pools=['Full', 'Incr'])))
+        self.assertIsNotNone(self.lock(Partition(pools=['Incr'])))
+
+    def test_finished_partition_is_not_running(self):
+        partition = Partition(clients=['a', 'b'])
+        locks = self.lock(partition)
+        path = lock_path('partition.' + partition.tag())
+        self.assertEqual(running_partition(path).to_dict(), partition.to_dict())
+        self.release(locks)
+        # The lock file stays behind with the selectors, but nobody holds it
+        self.assertIsNone(running_partition(path))
+        self.assertIsNotNone(self.lock(Partition(clients=['b'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Decisions reused from the checkpoint equal the ones of a --full run,
+volumes vanishing while --target-free planning ranks them, and the
+retention simulator against the decisions of a run on every day."""
+
+import io
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+from collections import Counter
+from contextlib import redirect_stdout
+from unittest import mock
+
+from delete_purged_volumes.catalog import CatalogJob, SQLiteCatalog
+from delete_purged_volumes.chains import ChainIndex
+from delete_purged_volumes.planner import (Checkpoint, decide_diff, decide_full, decide_incr, plan_removals,
+                                           reclaim_to_target)
+from delete_purged_volumes.simulate import RetentionPolicy, simulate_chain
+from delete_purged_volumes.scan import VolumeCache
+
+from .test_scan import VOL_LABEL, bb02_block, bb02_record
+
+DAY = 86400
+START = 1600000000
+
+
+def ser_string(s):
+    return s.encode('utf-8') + b'\0'
+
+
+def session_label(jobid, client, fileset, level, jobtdate):
+    return (ser_string('Bareos 2.0 immortal\n') + struct.pack('>IIqd', 20, jobid, jobtdate * 1000000, 0) +
+            b''.join(ser_string(s) for s in ('Full', 'Backup', 'job', client, 'job.%d' % jobid, fileset)) +
+            struct.pack('>II', ord('B'), ord(level)) + ser_string('md5'))
+
+
+class ChainsFixture(unittest.TestCase):
+    """Two clients with 70 daily jobs: a full every 14 days, a diff every 7
+    and incrementals between. The first 30 days are purged, client-a's
+    purged volumes keep their jobs in the catalog."""
+
+    clients = ('client-a', 'client-b')
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.archive = os.path.join(self.tmp, 'archive')
+        os.mkdir(self.archive)
+        self.checkpoint_file = os.path.join(self.tmp, 'state')
+        self.catalog = SQLiteCatalog(os.path.join(self.tmp, 'bareos.db'))
+        self.catalog.connect()
+        self.catalog.create_schema()
+        con = self.catalog.con
+        con.execute("INSERT INTO Storage VALUES (1, 'File')")
+        con.execute("INSERT INTO Pool VALUES (1, 'Full')")
+        con.execute("INSERT INTO FileSet VALUES (1, 'fs')")
+        jobid = 0
+        for c, client in enumerate(self.clients):
+            con.execute('INSERT INTO Client VALUES (?, ?)', (c + 1, client))
+            for day in range(70):
+                jobid += 1
+                level = 'F' if day % 14 == 0 else ('D' if day % 7 == 0 else 'I')
+                jobtdate = START + day * DAY
+                volname = '%s-%02d' % (client, day)
+                con.execute('INSERT INTO Job (JobId, Level, ClientId, JobTDate, FileSetId) VALUES (?, ?, ?, ?, 1)',
+                            (jobid, level, c + 1, jobtdate))
+                con.execute("INSERT INTO Media (MediaId, VolumeName, PoolId, StorageId, VolStatus) "
+                            "VALUES (?, ?, 1, 1, 'Used')", (jobid, volname))
+                con.execute('INSERT INTO JobMedia (JobId, MediaId) VALUES (?, ?)', (jobid, jobid))
+                with open(os.path.join(self.archive, volname), 'wb') as f:
+                    f.write(bb02_block(1, bb02_record(-2, 0, VOL_LABEL) +
+                                       bb02_record(-4, jobid, session_label(jobid, client, 'fs', level, jobtdate))))
+        con.commit()
+        self.purge('client-a', range(30), keep_jobs=True)
+        self.purge('client-b', range(30))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp)
+
+    def purge(self, client, days, keep_jobs=False):
+        con = self.catalog.con
+        for day in days:
+            volname = '%s-%02d' % (client, day)
+            con.execute("UPDATE Media SET VolStatus='Purged' WHERE VolumeName=?", (volname,))
+            if not keep_jobs:
+                con.execute('DELETE FROM JobMedia WHERE MediaId IN (SELECT MediaId FROM Media WHERE VolumeName=?)',
+                            (volname,))
+        con.commit()
+
+
+class CheckpointTest(ChainsFixture):
+
+    def plan(self, full_run):
+        """(volumes to remove with their reasons, decisions taken from the checkpoint)"""
+        reused = list()
+        get = Checkpoint.get
+
+        def counting_get(checkpoint, *args):
+            decision = get(checkpoint, *args)
+            if decision:
+                reused.append(args[2])
+            return decision
+
+        chains = ChainIndex(self.catalog.iter_jobs())
+        with mock.patch.object(Checkpoint, 'get', counting_get):
+            remove, reasons, storages = plan_removals(
+                chains, self.catalog.purged_volumes(), self.catalog.purged_volnames_with_jobs(),
+                {'File': [(self.archive, True)]}, full_run, cache=VolumeCache(None),
+                checkpoint_file=self.checkpoint_file)
+        return dict((os.path.basename(path), reasons[path]) for path in remove), reused
+
+    def test_incremental_equals_full(self):
+        first, reused = self.plan(full_run=False)
+        self.assertEqual(reused, [])
+        self.assertEqual(first, self.plan(full_run=True)[0])
+        # Some volumes are removed, the others kept
+        self.assertTrue(first)
+        self.assertLess(len(first), 60)
+
+        incremental, reused = self.plan(full_run=False)
+        self.assertEqual(incremental, first)
+        self.assertEqual(len(reused), 60)
+
+    def test_incremental_equals_full_after_purge(self):
+        first, reused = self.plan(full_run=False)
+        # client-a's days 30 to 43 get purged, the full of day 42 becomes removable
+        self.purge('client-a', range(30, 44))
+
+        incremental, reused = self.plan(full_run=False)
+        full, full_reused = self.plan(full_run=True)
+        self.assertEqual(incremental, full)
+        self.assertEqual(full_reused, [])
+        self.assertNotEqual(incremental, first)
+        # Only client-b's chain is unchanged, its decisions come from the checkpoint
+        self.assertEqual(Counter(v.split('-')[1] for v in reused), Counter({'b': 30}))
+
+
+class TargetFreeTest(ChainsFixture):
+
+    def test_vanished_volume_is_skipped(self):
+        volpaths = [os.path.join(self.archive, name) for name in sorted(os.listdir(self.archive))]
+        gone = os.path.join(self.archive, 'client-a-70')
+        reasons = dict()
+        chains = ChainIndex(self.catalog.iter_jobs())
+        # All of the filesystem free, every volume is decided
+        remove = reclaim_to_target(volpaths + [gone], (100, True), VolumeCache(None), chains,
+                                   self.catalog.purged_volnames_with_jobs(), reasons)
+        self.assertTrue(remove)
+        self.assertNotIn(gone, remove)
+        self.assertEqual(set(reasons), set(remove))
+
+
+class SimulatorTest(unittest.TestCase):
+    """simulate_chain deletes on every day what decide_full, decide_incr and
+    decide_diff would, run on the jobs not purged by then."""
+
+    days = 90
+
+    def random_chain(self, rnd):
+        """A chain whose jobs start before the simulated days, with random levels and gaps."""
+        jobs = list()
+        for day in range(-60, self.days + 1):
+            if jobs and rnd.random() < 0.2:
+                continue
+            level = 'F' if not jobs else rnd.choice('FDDIIIIIII')
+            jobtdate = START + day * DAY + rnd.randrange(DAY)
+            jobs.append(CatalogJob('vol-%d' % len(jobs), jobtdate, level, 'client', 'fs'))
+        retention = {'F': rnd.randint(10, 60), 'D': rnd.randint(3, 30), 'I': rnd.randint(1, 20)}
+        return jobs, RetentionPolicy({'retention': retention}).rules('client', 'fs')
+
+    def day_of(self, t):
+        return max(0, int(-(-(t - START) // DAY)))
+
+    def replay(self, jobs, rules):
+        """{day: volumes deleted} running the decisions on every day a job is written or purged."""
+        purge_day = dict((job.volumename, self.day_of(job.jobtdate + rules['retention'][job.level] * DAY))
+                         for job in jobs)
+        event_days = set([0]) | set(self.day_of(job.jobtdate) for job in jobs) | set(purge_day.values())
+        deleted = dict()
+        gone = set()
+        for day in sorted(x for x in event_days if x <= self.days):
+            chains = ChainIndex(job for job in jobs
+                                if self.day_of(job.jobtdate) <= day < purge_day[job.volumename])
+            vols = [{'vol': job.volumename, 'time': job.jobtdate, 'client': job.clientname,
+                     'fileset': job.fileset, 'id': 0, 'level': job.level, 'in_catalog': True}
+                    for job in jobs if purge_day[job.volumename] <= day and job.volumename not in gone]
+            purged_full_chains = ChainIndex([vol for vol in vols if vol['level'] == 'F'],
+                                            client_key='client', time_key='time', level_key=None)
+            for vol in vols:
+                if vol['level'] == 'F':
+                    remove, reason = decide_full(vol, chains, purged_full_chains)
+                elif vol['level'] == 'D':
+                    remove, reason = decide_diff(vol, chains)
+                else:
+                    remove, reason = decide_incr(vol, chains)
+                if remove:
+                    deleted.setdefault(day, set()).add(vol['vol'])
+            gone |= deleted.get(day, set())
+        return deleted
+
+    def test_random_chains(self):
+        rnd = random.Random(16)
+        for n in range(100):
+            jobs, rules = self.random_chain(rnd)
+            chain = ChainIndex(jobs).chain('client', 'fs')
+            simulated = dict((day, set(row.volumename for row in rows))
+                             for day, rows, kept in simulate_chain(chain, rules, START, self.days) if rows)
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(simulated, self.replay(jobs, rules), 'chain %d' % n)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""The native volume label reader against label bytes laid out like Bareos
+writes them (src/stored/block.h, record.h, label.c)."""
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from delete_purged_volumes import config, scan
+
+# Volume label record, FileIndex VOL_LABEL
+VOL_LABEL = bytes.fromhex(
+    '426172656f7320322e3020696d6d6f7274616c0a00'  # Id "Bareos 2.0 immortal\n"
+    '00000014'                                    # VerNum 20
+    '0005af3107a400000005af3107a40000'            # label_btime, write_btime
+    '00000000000000000000000000000000'            # write_date, write_time
+    '46756c6c2d303030310000'                      # VolumeName Full-0001, PrevVolumeName
+    '46756c6c004261636b757000'                    # PoolName Full, PoolType Backup
+    '46696c6500626172656f732d736400'              # MediaType File, HostName bareos-sd
+    '426172656f730032302e302e310030344d6172323100'  # LabelProg, ProgVersion, ProgDate
+)
+
+# Start of session label record, FileIndex SOS_LABEL, Stream JobId
+SOS_LABEL = bytes.fromhex(
+    '426172656f7320322e3020696d6d6f7274616c0a00'  # Id
+    '000000140000002a'                            # VerNum 20, JobId 42
+    '0005af3107a40000'                            # write_btime, 2020-09-13 12:26:40 UTC
+    '0000000000000000'                            # write_time
+    '46756c6c004261636b757000'                    # PoolName, PoolType
+    '6261636b75702d646200'                        # JobName backup-db
+    '64622d666400'                                # ClientName db-fd
+    '6261636b75702d64622e323032302d30392d31335f31322e32362e34305f303500'  # Job
+    '446253657400'                                # FileSetName DbSet
+    '0000004200000046'                            # JobType 'B', JobLevel 'F'
+    '496f456373523072622b54302b4b594c305859654c4100'  # FileSetMD5
+)
+
+# Session label before VerNum 11, the date is a julian day and time
+SOS_LABEL_V10 = bytes.fromhex(
+    '426163756c6120312e3020696d6d6f7274616c0a00'  # Id "Bacula 1.0 immortal\n"
+    '0000000a0000002a'                            # VerNum 10, JobId 42
+    '4142c2f1000000003fe0985f06f69446'            # write_date, write_time
+    '46756c6c004261636b757000'                    # PoolName, PoolType
+    '6261636b75702d646200'                        # JobName
+    '64622d666400'                                # ClientName
+    '6261636b75702d64622e323032302d30392d31335f31322e32362e34305f303500'  # Job
+    '446253657400'                                # FileSetName
+    '0000004200000046'                            # JobType, JobLevel
+)
+
+LABELS = [(-2, 0, VOL_LABEL), (-4, 42, SOS_LABEL)]
+EXPECTED = ('db-fd', 'DbSet', 1600000000 - 40, 'F', '42', 'Full-0001')
+
+
+def bb02_record(file_index, stream, data, data_len=None):
+    return struct.pack('>iiI', file_index, stream, len(data) if data_len is None else data_len) + data
+
+
+def bb02_block(number, body):
+    return struct.pack('>III4sII', 0, 24 + len(body), number, b'BB02', 1, 1600000000) + body
+
+
+def bb01_block(number, records):
+    body = b''.join(struct.pack('>IIiiI', 1, 1600000000, fi, stream, len(data)) + data
+                    for fi, stream, data in records)
+    return struct.pack('>III4s', 0, 16 + len(body), number, b'BB01') + body
+
+
+class LabelReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def volume(self, data, name='Full-0001'):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_bb02(self):
+        body = b''.join(bb02_record(*r) for r in LABELS)
+        path = self.volume(bb02_block(1, body) + b'\0' * 64)
+        self.assertEqual(scan.read_volume_label(path), EXPECTED)
+
+    def test_bb01(self):
+        path = self.volume(bb01_block(1, LABELS))
+        self.assertEqual(scan.read_volume_label(path), EXPECTED)
+
+    def test_label_split_over_blocks(self):
+        cut = 50
+        first = bb02_record(*LABELS[0]) + bb02_record(-4, 42, SOS_LABEL[:cut], len(SOS_LABEL))
+        # The rest goes on behind a header with the negated Stream and the bytes still to come
+        rest = bb02_record(-4, -42, SOS_LABEL[cut:])
+        path = self.volume(bb02_block(1, first) + bb02_block(2, rest))
+        self.assertEqual(scan.read_volume_label(path), EXPECTED)
+
+    def test_truncated_file(self):
+        body = b''.join(bb02_record(*r) for r in LABELS)
+        block = bb02_block(1, body)
+        for size in (10, 24, len(block) - 20):
+            path = self.volume(block[:size])
+            self.assertIsNone(scan.read_volume_label(path), size)
+
+    def test_label_before_version_11(self):
+        body = bb02_record(*LABELS[0]) + bb02_record(-4, 42, SOS_LABEL_V10)
+        path = self.volume(bb02_block(1, body))
+        self.assertIsNone(scan.read_volume_label(path))
+
+    def test_vanished_volume_is_skipped(self):
+        body = b''.join(bb02_record(*r) for r in LABELS)
+        path = self.volume(bb02_block(1, body))
+        gone = self.volume(bb02_block(1, body), 'Full-0002')
+        cache = scan.VolumeCache(None)
+        cache.put(gone, os.stat(gone), EXPECTED)
+        os.unlink(gone)
+        with mock.patch.object(config, 'native_label_reader', True):
+            self.assertEqual(scan.scan_volumes([path, gone], cache), {path: EXPECTED})
+        self.assertNotIn(gone, cache.entries)
+
+    def test_no_label_falls_back_to_bls(self):
+        path = self.volume(b'not a bareos volume\n' * 10)
+        fields = {'JobId': '42', 'ClientName': 'db-fd', 'FileSet': 'DbSet', 'JobLevel': 'F',
+                  'Date written': '13-Sep-2020 12:26'}
+        with mock.patch.object(config, 'native_label_reader', True), \
+                mock.patch.object(scan, 'run_bls', return_value=(fields, False)) as run_bls:
+            self.assertEqual(scan.parse_vol(path, 5), EXPECTED)
+        run_bls.assert_called_once_with(path, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Snapshots of a catalog that is written to while the snapshot is taken."""
+
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from delete_purged_volumes.catalog import SQLiteCatalog
+from delete_purged_volumes.snapshot import SNAPSHOT_FORMAT, SnapshotCatalog, write_snapshot
+
+
+class Exploit(object):
+    """Unpickling it creates the file path."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (open, (self.path, 'w'))
+
+
+class WriteSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, 'bareos.db')
+        self.snapshot = os.path.join(self.tmp, 'snapshot')
+        self.catalog = SQLiteCatalog(self.db)
+        self.catalog.connect()
+        self.catalog.create_schema()
+        con = self.catalog.con
+        # Readers keep their snapshot while the director writes
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute("INSERT INTO Storage VALUES (1, 'File')")
+        con.execute("INSERT INTO Pool VALUES (1, 'Full')")
+        con.execute("INSERT INTO FileSet VALUES (1, 'fs')")
+        con.execute("INSERT INTO Client VALUES (1, 'client')")
+        for i in range(1, 4):
+            self.add_volume(con, i, 'Purged' if i == 1 else 'Used')
+        con.commit()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def add_volume(con, i, volstatus='Used'):
+        con.execute("INSERT INTO Job (JobId, Level, ClientId, JobTDate, FileSetId) VALUES (?, 'F', 1, ?, 1)",
+                    (i, 1600000000 + i))
+        con.execute('INSERT INTO Media (MediaId, VolumeName, PoolId, StorageId, VolStatus) VALUES (?, ?, 1, 1, ?)',
+                    (i, 'vol-%d' % i, volstatus))
+        con.execute('INSERT INTO JobMedia (JobId, MediaId) VALUES (?, ?)', (i, i))
+
+    def write_during_snapshot(self):
+        """Writes the snapshot, jobs are written to new volumes right after the volumes were read."""
+        iter_media = self.catalog.iter_media
+
+        def iter_media_then_write():
+            for row in iter_media():
+                yield row
+            director = sqlite3.connect(self.db)
+            self.add_volume(director, 4)
+            self.add_volume(director, 5, 'Purged')
+            director.commit()
+            director.close()
+
+        with mock.patch.object(self.catalog, 'iter_media', iter_media_then_write):
+            write_snapshot(self.catalog, self.snapshot)
+        snapshot = SnapshotCatalog(self.snapshot)
+        snapshot.connect()
+        return snapshot
+
+    def test_one_read_transaction(self):
+        snapshot = self.write_during_snapshot()
+        self.assertEqual(snapshot.media_volnames(), set(['vol-1', 'vol-2', 'vol-3']))
+        self.assertEqual(sorted(job.volumename for job in snapshot.iter_jobs()), ['vol-2', 'vol-3'])
+        self.assertEqual(snapshot.purged_volnames_with_jobs(), set(['vol-1']))
+        # The write is seen once the transaction is over
+        self.assertIn('vol-4', self.catalog.media_volnames())
+
+    def test_volume_written_between_reads_is_left_out(self):
+        with mock.patch.object(SQLiteCatalog, 'begin_read', None):
+            snapshot = self.write_during_snapshot()
+        self.assertEqual(snapshot.media_volnames(), set(['vol-1', 'vol-2', 'vol-3']))
+        self.assertEqual(sorted(job.volumename for job in snapshot.iter_jobs()), ['vol-2', 'vol-3'])
+        self.assertEqual(snapshot.purged_volnames_with_jobs(), set(['vol-1']))
+
+
+    def test_pickle_is_not_loaded(self):
+        marker = os.path.join(self.tmp, 'unpickled')
+        with open(self.snapshot, 'wb') as f:
+            pickle.dump(Exploit(marker), f)
+        with self.assertRaises(ValueError):
+            SnapshotCatalog(self.snapshot).connect()
+        self.assertFalse(os.path.exists(marker))
+
+    def test_other_version_is_refused(self):
+        write_snapshot(self.catalog, self.snapshot)
+        with open(self.snapshot, 'rb') as f:
+            header, data = json.loads(f.readline().decode('utf-8')), f.read()
+        with open(self.snapshot, 'wb') as f:
+            f.write((json.dumps(dict(header, version=2)) + '\n').encode('utf-8') + data)
+        self.assertEqual(header['format'], SNAPSHOT_FORMAT)
+        snapshot = SnapshotCatalog(self.snapshot)
+        with self.assertRaises(ValueError):
+            snapshot.connect()
+        self.assertFalse(hasattr(snapshot, 'data'))
+
+
+if __name__ == '__main__':
+    unittest.main()